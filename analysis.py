@@ -7,15 +7,733 @@ from datetime import datetime
 import shutil
 import object as obj
 import movement as mov
+import numpy as np
+from utils import shift_coordinates, DEFAULT_PROPERTIES
+from cache import StageCache
+from raw import RawWriter
+from results import ResultsSink, add_partition, EXTENSIONS
+from tracking import Tracker
+from pipeline import prefetch, BackgroundWriter, check
+from profiling import Profiler, VIDEO_STAGES, WATERSHED_STAGES, MOVEMENT_STAGES, RESULTS_STAGES
 import cv2 as cv
+import time
+
+
+def log(message):
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + message)
+
+
+def video_params(params):
+    if "denoise" in params["video"].keys():
+        denoise = True
+        if params["video"]["denoise"] is None or "disk" not in params["video"]["denoise"].keys():
+            disk = 2
+        else:
+            disk = params["video"]["denoise"]["disk"]
+        if params["video"]["denoise"] is not None and "method" in params["video"]["denoise"].keys():
+            # denoising is done as a separate step after the frames are read
+            denoise = False
+    else:
+        denoise = False
+        disk = None
+
+    if params["video"].get("invert", False):
+        invert = True
+    else:
+        invert = False
+    return invert, denoise, disk
+
+
+# the part of the video to use, step is used to only read every nth frame
+def frame_range(params):
+    return params["video"].get("start", 0), params["video"].get("stop"), params["video"].get("step", 1)
+
+
+def output_video_params(params):
+    if params["output"]["video"] is None:
+        params["output"]["video"] = {}
+    if "size" not in params["output"]["video"].keys():
+        size = (6, 3)
+    else:  # this will give a key error is the user messes up so I'm going to leave it
+        size = (params["output"]["video"]["size"]["width"],
+                params["output"]["video"]["size"]["height"])
+
+    if "FPS" not in params["output"]["video"].keys():
+        FPS = 10
+    else:
+        FPS = params["output"]["video"]["FPS"]
+
+    if "periodicity" not in params['output']["video"].keys():
+        period = 30
+    else:
+        period = params["output"]["video"]["periodicity"]
+    return size, FPS, period
+
+
+def wants_output(params, output):
+    return "output" in params.keys() and params["output"] is not None and output in params["output"]
+
+
+# every nth frame that is used in the mp4 output, None if there is no mp4 output
+def mp4_period(params):
+    if wants_output(params, "video"):
+        return output_video_params(params)[2]
+    return None
+
+
+def render_params(params):
+    return {"backend": params["output"]["video"].get("backend", "opencv"),
+            "contours": params["output"]["video"].get("contours", False),
+            "normalize": params["output"]["video"].get("normalize", False)}
+
+
+def raw_compression(params):
+    if isinstance(params["output"], dict) and params["output"]["raw"] is not None:
+        return params["output"]["raw"].get("compression", "gzip")
+    return "gzip"
+
+
+def mp4_downsample(params):
+    if wants_output(params, "video") and params["output"]["video"] is not None:
+        return params["output"]["video"].get("downsample", 1)
+    return 1
+
+
+def reference_frame_index(params):
+    if "reference_frame" in params["video"]["normalize"]:
+        return params["video"]["normalize"]["reference_frame"]
+    else:
+        return None
+
+
+# video: crop: roi: is a box [y0, y1, x0, x1] or auto to find the box around the object in the first frames, every
+# stage after reading the frames only uses this part of them
+def video_crop(myvid, params):
+    if "crop" not in params["video"] or params["video"]["crop"] is None:
+        return None
+    crop = params["video"]["crop"]
+    if crop.get("roi", "auto") != "auto":
+        return [int(value) for value in crop["roi"]]
+    invert = video_params(params)[0]
+    start, stop, step = frame_range(params)
+    box = myvid.detect_roi(count=crop.get("frames", 10), margin=crop.get("margin", 16), start=start, stop=stop,
+                           step=step, invert=invert, spread=crop.get("spread", False))
+    log("Cropping " + myvid.file + " to " + str(box))
+    return box
+
+
+# the movement roi is a dictionary of regions in the coordinates of the whole frame, the boxes [y0, y1, x0, x1] are
+# moved to the coordinates of the crop and clipped to it and the boolean masks are cut to the crop
+def crop_roi(roi, crop):
+    if roi is None or crop is None:
+        return roi
+    height, width = crop[1] - crop[0], crop[3] - crop[2]
+    cropped = {}
+    for name, region in roi.items():
+        if np.ndim(region) == 2:
+            cropped[name] = np.asarray(region, dtype=bool)[crop[0]:crop[1], crop[2]:crop[3]]
+        else:
+            y0, y1, x0, x1 = region
+            cropped[name] = [min(max(y0 - crop[0], 0), height), min(max(y1 - crop[0], 0), height),
+                             min(max(x0 - crop[2], 0), width), min(max(x1 - crop[2], 0), width)]
+    return cropped
+
+
+def preprocess_stages(params):
+    stages = []
+    if "denoise" in params["video"].keys() and params["video"]["denoise"] is not None \
+            and "method" in params["video"]["denoise"].keys():
+        stages.append("denoise")
+    if "adjust" in params["video"].keys():
+        if "method" not in params["video"]["adjust"]:
+            raise ValueError("You did not specify an adjustment algorithm")
+        stages.append("adjust")
+    if "normalize" in params["video"]:
+        stages.append("normalize")
+    return stages
+
+
+def preprocess_stage(myvid, params, stage, frames=None, reference=None, cores=1):
+    if stage == "denoise":
+        frames = myvid.denoise(method=params["video"]["denoise"]["method"],
+                               dsk=params["video"]["denoise"].get("disk", 2),
+                               window=params["video"]["denoise"].get("window", 3), frames=frames,
+                               inplace=frames is None, cores=cores)
+    elif stage == "adjust":
+        frames = myvid.adjust(method=params["video"]["adjust"]["method"], frames=frames,
+                              inplace=frames is None, dtype=params["video"]["adjust"].get("dtype"),
+                              cores=cores, **params["video"]["adjust"].get("method_params", {}))
+    elif stage == "normalize":
+        dtype = params["video"]["normalize"].get("dtype")
+        if reference is not None:
+            frames = myvid.normalize_frames(frames=frames, inplace=False, reference=reference, dtype=dtype,
+                                            cores=cores)
+        else:
+            frames = myvid.normalize_frames(frames=frames, inplace=frames is None,
+                                            reference_frame=reference_frame_index(params), dtype=dtype, cores=cores)
+    return frames
+
+
+def preprocess(myvid, params, frames=None, reference=None, cores=1):
+    for stage in preprocess_stages(params):
+        frames = preprocess_stage(myvid, params, stage, frames=frames, reference=reference, cores=cores)
+    return frames
+
+
+def stage_cache(params):
+    if "cache" not in params.keys() or params["cache"] is None:
+        return None
+    max_size = params["cache"].get("max_size")
+    if max_size is not None:
+        max_size = int(max_size * 2 ** 30)
+    return StageCache(params["cache"].get("directory", ".cache"), max_size=max_size,
+                      compression=params["cache"].get("compression", "lzf"))
+
+
+def cached_thresholds(cache, key):
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    # the rows of a memory mapped array are memmaps too, multi_otsu thresholds are returned as plain arrays
+    return [np.array(threshold) if np.ndim(threshold) > 0 else threshold for threshold in cached["threshold"]]
+
+
+# reads and preprocesses the frames starting from the last stage that is in the cache, the output of every stage
+# that is calculated is cached. Returns the key of the last stage for the stages that use the frames
+def cached_frames(myvid, params, cache, cores=1, crop=None):
+    invert, denoise, disk = video_params(params)
+    start, stop, step = frame_range(params)
+    decode = {"invert": invert, "denoise": denoise, "disk": disk, "start": start, "stop": stop, "step": step}
+    if crop is not None:
+        decode["crop"] = crop
+    keys = [cache.key(cache.file_hash(myvid.file), "decode", decode)]
+    stages = preprocess_stages(params)
+    for stage in stages:
+        keys.append(cache.key(keys[-1], stage, params["video"][stage]))
+
+    done = 0
+    for i in reversed(range(len(keys))):
+        cached = cache.get(keys[i])
+        if cached is not None:
+            log("Using cached frames for " + myvid.file + " up to " + (["decode"] + stages)[i])
+            myvid.frames = cached["frames"]
+            myvid.crop = crop
+            done = i + 1
+            break
+    if done == 0:
+        myvid.get_frames(invert=invert, denoise=denoise, dsk=disk, start=start, stop=stop, step=step, cores=cores,
+                         crop=crop)
+        cache.put(keys[0], frames=myvid.frames.array)
+        done = 1
+    for i in range(done, len(keys)):
+        preprocess_stage(myvid, params, stages[i - 1], cores=cores)
+        cache.put(keys[i], frames=myvid.frames.array)
+    return keys[-1]
+
+
+def check_params(params):
+    if params["method"] == "object_detection":
+        if "algorithm" not in params["threshold"].keys():
+            raise ValueError("You did not specify a tresholding algorithm")
+    elif params["method"] == "movement_detection":
+        if "type" not in params.keys():
+            raise ValueError(
+                "You did not specify a calculation type, it's either background_subtraction or optical_flow")
+        elif "algorithm" not in params.keys():
+            raise ValueError("You did not specify an algorithm to use see readme for details")
+        elif params["type"] not in ["background_subtraction", "optical_flow"]:
+            raise ValueError("type can only be background_subtraction or optical_flow")
+    else:
+        raise ValueError("method can only be object_detection or movement_detection")
+    if params.get("tracking") and params["method"] != "object_detection":
+        raise ValueError("tracking can only be used with object_detection")
+
+
+# tiles: size: and overlap: split large frames into tiles for the segmentation and the properties
+def tile_params(params):
+    if "tiles" not in params or not params["tiles"]:
+        return {}
+    size = params["tiles"]["size"]
+    return {"tile": tuple(size) if isinstance(size, list) else size, "overlap": params["tiles"].get("overlap", 32)}
+
+
+# tracking: max_distance:, memory: and area_weight: link the regions of consecutive frames, tracking: true uses the
+# defaults. The frame numbers of consecutive frames differ by the step of frames
+def tracking_params(params):
+    if not params.get("tracking"):
+        return None
+    tracking = params["tracking"] if isinstance(params["tracking"], dict) else {}
+    return {"max_distance": tracking.get("max_distance", 50), "memory": tracking.get("memory", 0),
+            "area_weight": tracking.get("area_weight", 1.0), "step": frame_range(params)[2]}
+
+
+# the tracks are matched by the centroid and the bounding box of the regions so they are always calculated when
+# tracking is used
+def calculate_params(params):
+    calculate = dict(params.get("calculate") or {})
+    if tracking_params(params) is not None:
+        properties = calculate.get("properties") or DEFAULT_PROPERTIES
+        calculate["properties"] = list(properties) + [prop for prop in ["centroid", "bbox"] if prop not in properties]
+    return calculate
+
+
+def movement_function(movement, params):
+    if params["type"] == "background_subtraction":
+        return movement.background_subtractor(algo=params["algorithm"]["name"],
+                                              **params["algorithm"].get("algo_params", {}))
+    else:
+        return movement.dense_flow(params["algorithm"]["name"], **params["algorithm"].get("algo_params", {}))
+
+
+def flow_params(params, crop=None):
+    return {"level": params["algorithm"].get("level", 0),
+            "percentiles": tuple(params["algorithm"].get("percentiles", (50, 90, 99))),
+            "bins": params["algorithm"].get("bins", 8), "roi": crop_roi(params.get("roi"), crop)}
+
+
+# the masks of background subtraction are reduced to time series as they are generated, keep is every nth mask for
+# the mp4 output
+def movement_reducer(params, keep=None, crop=None):
+    decay = None
+    if wants_output(params, "heatmap") and isinstance(params["output"], dict) and params["output"]["heatmap"]:
+        decay = params["output"]["heatmap"].get("decay")
+    return mov.MovementReducer(roi=crop_roi(params.get("roi"), crop), foreground=params["algorithm"].get("foreground", 0),
+                               heatmap=wants_output(params, "heatmap"), decay=decay, keep=keep)
+
+
+# the frame column of the object properties is the index in the frames that were read, here it is changed to the
+# frame number in the video and the coordinates of cropped frames to the coordinates of the whole frame
+def object_results(measures, params, crop=None):
+    start, stop, step = frame_range(params)
+    measures["frame"] = start + measures["frame"] * step
+    return shift_coordinates(measures, crop)
+
+
+def results_sink(params, resultsdir):
+    options = {}
+    if wants_output(params, "results") and isinstance(params["output"], dict) and params["output"]["results"]:
+        options = params["output"]["results"]
+    return ResultsSink(resultsdir, format=options.get("format", "parquet"), excel=options.get("excel", False))
+
+
+# sums is a list for background subtraction and a data frame of flow statistics for optical flow
+def movement_results(sums, params):
+    if params["type"] == "background_subtraction":
+        column = "movement"
+    elif params["algorithm"]["return"] == "magnitude":
+        column = "total_movement"
+    else:
+        column = "aggregate_angle"
+    start, stop, step = frame_range(params)
+    frames = range(start, start + len(sums) * step, step)
+    if isinstance(sums, pd.DataFrame):
+        results = sums.rename(columns={"sum": column, "total": column})
+        results.insert(0, "frame", list(frames))
+        return results
+    return pd.DataFrame(list(zip(frames, sums)), columns=['frame', column])
+
+
+# decoded is a video whose frames were already read by load_video
+def analyze(file, params, cores, profiler=None, decoded=None):
+    log("Parsing frames for " + file)
+    myvid = instrument(decoded if decoded is not None else vid.Video(path=file), profiler, VIDEO_STAGES)
+    crop = myvid.crop if decoded is not None else video_crop(myvid, params)
+    packed = params.get("packed_masks", False)
+    cache = stage_cache(params)
+    if cache is not None:
+        frames_key = cached_frames(myvid, params, cache, cores=cores, crop=crop)
+        threshold_key = cache.key(frames_key, "threshold", params.get("threshold"))
+        segmentation_key = cache.key(threshold_key, "segmentation", params.get("segmentation_params")
+                                     if "tiles" not in params else [params.get("segmentation_params"),
+                                                                    params["tiles"]])
+    else:
+        if decoded is None:
+            invert, denoise, disk = video_params(params)
+            start, stop, step = frame_range(params)
+            myvid.get_frames(invert=invert, denoise=denoise, dsk=disk, start=start, stop=stop, step=step,
+                             cores=cores, crop=crop)
+        preprocess(myvid, params, cores=cores)
+
+    frames = None
+    masks = None
+    heatmap = None
+    if params["method"] == "object_detection" and not wants_output(params, "raw"):
+        # without the hdf5 output the masks are not needed so all three steps are done in a single task per frame
+        period = mp4_period(params)
+        with instrument(obj.Watershed(cores=cores), profiler, WATERSHED_STAGES) as seg:
+            log("Detecting objects " + file)
+            if "calculate" not in params.keys():
+                print("Using default values for property calculations see readme for details")
+            thresholds = cached_thresholds(cache, threshold_key) if cache is not None else None
+            results = seg.detect(Video=myvid, method=params["threshold"]["algorithm"], cores=cores,
+                                 thresholds=thresholds,
+                                 threshold_params=params["threshold"].get("algorithm_params", {}),
+                                 temporal=params["threshold"].get("temporal", False),
+                                 drift=params["threshold"].get("drift"),
+                                 segmentation_params=params.get("segmentation_params", {}),
+                                 properties_params=calculate_params(params), keep_masks=period,
+                                 downsample=mp4_downsample(params), packed=packed, **tile_params(params))
+            results = object_results(results, params, crop)
+            if cache is not None and thresholds is None:
+                cache.put(threshold_key, threshold=myvid.threshold)
+        if period is not None:
+            frames = myvid.frames[::period]
+            masks = myvid.masks
+
+    elif params["method"] == "object_detection":
+        # the same worker pool is used for all three steps
+        with instrument(obj.Watershed(cores=cores), profiler, WATERSHED_STAGES) as seg:
+            if cache is not None and threshold_key in cache:
+                log("Using cached thresholds for " + file)
+                myvid.threshold = cached_thresholds(cache, threshold_key)
+            else:
+                log("Calculating thresholding valules " + file)
+                seg.threshold(Video=myvid, method=params["threshold"]["algorithm"], cores=cores,
+                              temporal=params["threshold"].get("temporal", False),
+                              drift=params["threshold"].get("drift"), **params["threshold"].get("algorithm_params", {}))
+                if cache is not None:
+                    cache.put(threshold_key, threshold=myvid.threshold)
+            if cache is not None and segmentation_key in cache:
+                log("Using cached segmentation for " + file)
+                myvid.masks = cache.get(segmentation_key)["masks"]
+                if packed:
+                    myvid.masks = vid.PackedMasks.from_frames(myvid.masks)
+            else:
+                log("Performing watershed segmentation " + file)
+                seg.segmentation(Video=myvid, cores=cores, packed=packed, **tile_params(params),
+                                 **params.get("segmentation_params", {}))
+                if cache is not None:
+                    cache.put(segmentation_key, masks=myvid.masks.array)
+            log("Calculating properties " + file)
+            if "calculate" not in params.keys():
+                print("Using default values for property calculations see readme for details")
+            results = seg.properties(Video=myvid, cores=cores, tile=tile_params(params).get("tile"),
+                                     **calculate_params(params))
+            results = object_results(results, params, crop)
+
+    elif params["type"] == "background_subtraction":
+        # the masks are only kept for the hdf5 output, otherwise every mask is reduced and dropped
+        movement = instrument(mov.Movement(), profiler, MOVEMENT_STAGES)
+        period = mp4_period(params)
+        if params["algorithm"].get("sharded", False) or wants_output(params, "raw"):
+            reducer = movement_reducer(params, crop=crop)
+            if params["algorithm"].get("sharded", False):
+                log("Performing sharded background subtraction " + file)
+                movement.sharded_background(myvid, algo=params["algorithm"]["name"], cores=cores,
+                                            shards=params["algorithm"].get("shards"),
+                                            overlap=params["algorithm"].get("overlap", 100),
+                                            **params["algorithm"].get("algo_params", {}))
+            else:
+                log("Performing background subtraction " + file)
+                movement.movement(myvid, method="background", function=movement_function(movement, params))
+            for mask in myvid.masks:
+                reducer.add(mask)
+        else:
+            reducer = movement_reducer(params, keep=period, crop=crop)
+            log("Performing background subtraction " + file)
+            movement.reduce(myvid, method="background", function=movement_function(movement, params),
+                            reducer=reducer)
+            if period is not None:
+                frames = myvid.frames[::period]
+                masks = reducer.kept
+        heatmap = reducer.heatmap
+        results = movement_results(reducer.results(), params)
+
+    else:
+        # the flow fields are only kept when they are written to the output
+        log("Performing dense optical flow " + file)
+        movement = instrument(mov.Movement(), profiler, MOVEMENT_STAGES)
+        stats = movement.optical_flow(myvid, algo=params["algorithm"]["name"], get=params["algorithm"]["return"],
+                                      cores=cores, keep_fields=wants_output(params, "video") or
+                                      wants_output(params, "raw") or wants_output(params, "heatmap"),
+                                      **flow_params(params, crop), **params["algorithm"].get("algo_params", {}))
+        if wants_output(params, "heatmap"):
+            reducer = movement_reducer(params, crop=crop)
+            for mask in myvid.masks:
+                reducer.add(mask)
+            heatmap = reducer.heatmap
+        results = movement_results(stats, params)
+
+    return myvid, results, frames, masks, heatmap
+
+
+# frames are read, adjusted and analysed in chunks of chunk_size so the memory use does not depend on the
+# length of the video. Only every nth frame and mask that is needed for the mp4 output is kept. The next chunks are
+# decoded in a background thread while a chunk is analysed and with background the rows and the hdf5 chunks are
+# written in the writer thread
+def analyze_stream(file, params, cores, chunk_size, raw=None, sink=None, profiler=None, tracker=None,
+                   background=None):
+    log("Streaming frames for " + file + " in chunks of " + str(chunk_size))
+    myvid = instrument(vid.Video(path=file), profiler, VIDEO_STAGES)
+    invert, denoise, disk = video_params(params)
+    crop = video_crop(myvid, params)
+    myvid.crop = crop
+    packed = params.get("packed_masks", False)
+
+    reference = None
+    if "normalize" in params["video"]:
+        index = reference_frame_index(params)
+        if index is None:
+            print("No reference frame provided using the first frame as reference")
+            index = 0
+        # the index is relative to the frames that are read
+        index = frame_range(params)[0] + index * frame_range(params)[2]
+        reference = myvid.read_frame(index, invert=invert, denoise=denoise, dsk=disk, crop=crop)
+        if "denoise" in params["video"].keys() and params["video"]["denoise"] is not None \
+                and params["video"]["denoise"].get("method", "temporal") != "temporal":
+            reference = myvid.denoise(method=params["video"]["denoise"]["method"],
+                                      dsk=params["video"]["denoise"].get("disk", 2), frames=[reference],
+                                      inplace=False)[0]
+        if "adjust" in params["video"].keys():
+            reference = myvid.adjust(method=params["video"]["adjust"]["method"], frames=[reference],
+                                     inplace=False, dtype=params["video"]["adjust"].get("dtype"),
+                                     **params["video"]["adjust"].get("method_params", {}))[0]
+
+    period = mp4_period(params)
+
+    if params["method"] == "object_detection":
+        seg = instrument(obj.Watershed(cores=cores), profiler, WATERSHED_STAGES).start()
+    elif params["type"] == "background_subtraction":
+        movement = instrument(mov.Movement(), profiler, MOVEMENT_STAGES)
+        function = movement_function(movement, params)
+        reducer = movement_reducer(params, keep=period, crop=crop)
+    else:
+        movement = instrument(mov.Movement(cores=cores), profiler, MOVEMENT_STAGES).start()
+        reducer = movement_reducer(params, crop=crop)
+
+    # with the hdf5 output every mask is needed and written with its chunk
+    writer = None
+    if raw is not None:
+        writer = RawWriter(raw, compression=raw_compression(params), params=params, crop=crop)
+
+    results = []
+    kept_frames = []
+    kept_masks = []
+    previous = None
+    offset = 0
+    start, stop, step = frame_range(params)
+    chunks = myvid.stream_frames(invert=invert, denoise=denoise, dsk=disk, chunk_size=chunk_size, start=start,
+                                 stop=stop, step=step, crop=crop)
+    ahead = params["video"].get("prefetch", 2)
+    if ahead:
+        chunks = prefetch(chunks, size=ahead)
+    if profiler is not None:
+        # with prefetch this is the time the analysis waited for the frames
+        chunks = profiler.iterate(chunks, "decode")
+    for chunk in chunks:
+        chunk = preprocess(myvid, params, frames=chunk, reference=reference, cores=cores)
+        if params["method"] == "object_detection":
+            measures, thresholds, masks = seg.detect(frames=chunk, method=params["threshold"]["algorithm"],
+                                                     cores=cores, inplace=False,
+                                                     threshold_params=params["threshold"].get("algorithm_params", {}),
+                                                     temporal=params["threshold"].get("temporal", False),
+                                                     drift=params["threshold"].get("drift"),
+                                                     segmentation_params=params.get("segmentation_params", {}),
+                                                     properties_params=calculate_params(params),
+                                                     keep_masks=period if writer is None else 1,
+                                                     downsample=mp4_downsample(params) if writer is None else 1,
+                                                     offset=offset, packed=packed, **tile_params(params))
+            # the rows are written as they are calculated when there is a sink, the tracks continue across the chunks
+            if sink is not None and tracker is not None:
+                submit(background, sink.append, tracker.add(object_results(measures, params, crop)))
+            elif sink is not None:
+                submit(background, sink.append, object_results(measures, params, crop))
+            else:
+                results.append(measures)
+            if writer is None:
+                kept_masks.extend(masks)
+            else:
+                submit(background, writer.append, chunk, masks, thresholds)
+            seg.release()
+        elif params["type"] == "background_subtraction" and writer is not None:
+            masks = movement.movement(None, method="background", function=function, frames=chunk, inplace=False)
+            for mask in masks:
+                reducer.add(mask)
+            submit(background, writer.append, chunk, masks)
+        elif params["type"] == "background_subtraction":
+            movement.reduce(frames=chunk, method="background", function=function, reducer=reducer)
+        else:
+            keep_fields = period is not None or wants_output(params, "heatmap") or writer is not None
+            stats = movement.optical_flow(frames=chunk, algo=params["algorithm"]["name"],
+                                          get=params["algorithm"]["return"], cores=cores, keep_fields=keep_fields,
+                                          previous=previous, inplace=False, **flow_params(params, crop),
+                                          **params["algorithm"].get("algo_params", {}))
+            if keep_fields:
+                stats, masks = stats
+            if wants_output(params, "heatmap"):
+                for mask in masks:
+                    reducer.add(mask)
+            previous = chunk[-1]
+            results.append(stats)
+            if writer is not None:
+                submit(background, writer.append, chunk, masks)
+
+        if period is not None:
+            for i in range(len(chunk)):
+                if (offset + i) % period == 0:
+                    kept_frames.append(chunk[i])
+                    if params["method"] == "object_detection" and writer is not None:
+                        downsample = mp4_downsample(params)
+                        kept_masks.append(masks[i][::downsample, ::downsample])
+                    elif params["method"] != "object_detection" and params["type"] == "optical_flow":
+                        kept_masks.append(masks[i])
+        offset += len(chunk)
+        log("Processed " + str(offset) + " frames of " + file)
+
+    if writer is not None:
+        submit(background, writer.close)
+    heatmap = None
+    if params["method"] == "object_detection":
+        seg.close()
+        results = object_results(pd.concat(results, ignore_index=True), params, crop) if sink is None else None
+    elif params["type"] == "background_subtraction":
+        kept_masks = reducer.kept
+        heatmap = reducer.heatmap
+        results = movement_results(reducer.results(), params)
+    else:
+        movement.close()
+        heatmap = reducer.heatmap
+        results = movement_results(pd.concat(results, ignore_index=True), params)
+    return myvid, results, kept_frames, kept_masks, heatmap
+
+
+# with background the function runs in the writer thread, see pipeline.py
+def submit(background, function, *args, **kwargs):
+    if background is None:
+        return function(*args, **kwargs)
+    return background.submit(function, *args, **kwargs)
+
+
+# one row per track next to the results
+def write_tracks(resultsdir, summary, format):
+    with ResultsSink(resultsdir, name="tracks", format=format) as tracks:
+        tracks.append(summary)
+
+
+# results is None when the rows were already written to the sink. With background the files are written in the
+# writer thread and the function returns before they are done
+def write_outputs(myvid, results, params, resultsdir, file, frames=None, masks=None, heatmap=None, sink=None,
+                  profiler=None, tracker=None, background=None):
+    os.makedirs(resultsdir, exist_ok=True)
+    if sink is None:
+        sink = instrument(results_sink(params, resultsdir), profiler, RESULTS_STAGES)
+    if results is not None:
+        submit(background, sink.append, results)
+    submit(background, sink.close)
+    if tracker is not None:
+        submit(background, write_tracks, resultsdir, tracker.summary(), sink.format)
+
+    if "output" in params.keys() and params["output"] is not None:
+        if "video" in params["output"]:
+            vidname = resultsdir + "/results.mp4"
+            log("Generating mp4 for " + file)
+            size, FPS, period = output_video_params(params)
+            if frames is not None:
+                # the frames are already subsampled when they are streamed or when objects are detected in one step
+                submit(background, myvid.write_mp4, output=vidname, frames=frames, masks=masks, size=size, FPS=FPS,
+                       period=1, **render_params(params))
+            else:
+                submit(background, myvid.write_mp4, output=vidname, size=size, FPS=FPS, period=period,
+                       **render_params(params))
+
+        if "heatmap" in params["output"] and heatmap is not None:
+            submit(background, myvid.write_heatmap, resultsdir + "/heatmap.png", heatmap)
+
+        if "raw" in params["output"] and frames is None:
+            # streamed videos are written while they are analysed
+            rawname = resultsdir + "/raw_data.hdf5"
+            submit(background, myvid.write_raw, rawname, thresholds=myvid.threshold,
+                   compression=raw_compression(params), params=params)
+
+
+# with a profiler the methods of the instance are timed, see profiling.py
+def instrument(instance, profiler, stages):
+    if profiler is None:
+        return instance
+    return profiler.instrument(instance, stages)
+
+
+def video_name(file, extension):
+    filename = file.split("/").pop()
+    filename = filename.replace(extension, "")
+    filename = filename.replace(" ", "")
+    return filename
+
+
+# the time the last file of the video was written
+def finish(file, writes):
+    check(writes)
+    log(file + " done!")
+    return time.time()
+
+
+# the files are written in the background writer, which is started here when none is given. Returns the future of
+# the last write, its result is the time the video was done and it raises the errors of the writes of the video
+def run_file(file, params, cores, output, config_yaml, extension, background=None, decoded=None):
+    if background is None:
+        with BackgroundWriter() as background:
+            done = run_file(file, params, cores, output, config_yaml, extension, background=background,
+                            decoded=decoded)
+        done.result()
+        return done
+
+    resultsdir = os.path.abspath(output) + "/" + video_name(file, extension)
+    profile = params.get("profile") or {}
+    profiler = Profiler(cores=cores, profile=profile.get("stage"), mode=profile.get("mode", "cprofile"))
+    tracking = tracking_params(params)
+    tracker = Tracker(**tracking) if tracking is not None else None
+
+    try:
+        if "chunk_size" in params["video"].keys():
+            raw = None
+            if wants_output(params, "raw"):
+                os.makedirs(resultsdir, exist_ok=True)
+                raw = resultsdir + "/raw_data.hdf5"
+            sink = instrument(results_sink(params, resultsdir), profiler, RESULTS_STAGES)
+            myvid, results, frames, masks, heatmap = analyze_stream(file, params, cores,
+                                                                    params["video"]["chunk_size"], raw=raw,
+                                                                    sink=sink, profiler=profiler, tracker=tracker,
+                                                                    background=background)
+        else:
+            sink = None
+            myvid, results, frames, masks, heatmap = analyze(file, params, cores, profiler=profiler,
+                                                             decoded=decoded)
+        if tracker is not None and results is not None:
+            log("Tracking objects " + file)
+            results = tracker.add(results)
+
+        log("Preparing results for " + file)
+        write_outputs(myvid, results, params, resultsdir, file, frames=frames, masks=masks, heatmap=heatmap,
+                      sink=sink, profiler=profiler, tracker=tracker, background=background)
+        background.submit(shutil.copy, config_yaml, resultsdir + "/config.yaml")
+        background.submit(profiler.write, resultsdir)
+    finally:
+        # the writes of a video that failed are not checked with the next video
+        writes = background.take()
+        profiler.close()
+    done = background.submit(finish, file, writes)
+    # the check is not one of the writes of the next video
+    background.take()
+    return done
+
 
 if __name__ == "__main__":
+    from scheduler import schedule
+
     parser = arg.ArgumentParser(description='detect objects or movements in a video file')
     parser.add_argument('-f', '--filename', type=str, help='video file', action="store", default=None)
     parser.add_argument('-d', '--directory', type=str, help="directory of video files and nothing else", default=None)
     parser.add_argument('-y', '--config_yaml', type=str, help='path of the config.yaml file', action="store")
     parser.add_argument('-e', '--extension', type=str, help='file extension default .avi', action="store",
                         default=".avi")
+    parser.add_argument('-j', '--jobs', type=int, help='number of videos analysed at the same time with -d, default '
+                                                       'is as many as the cores', action="store", default=None)
+    parser.add_argument('-m', '--memory', type=float, help='memory limit in GB for the videos analysed at the same '
+                                                          'time, default is the available memory', action="store",
+                        default=None)
+    parser.add_argument('-t', '--use_object_tracking', help='link the detected objects of consecutive frames into '
+                                                            'tracks with the default tracking parameters',
+                        action="store_true")
     parser.add_argument('-o', '--output', type=str, help='name of the output directory, this will have subdirectories if                         -d option is used',
                         action="store")
     args = parser.parse_args()
@@ -40,137 +758,41 @@ if __name__ == "__main__":
                 files.append(args.directory + "/" + file)
             else:
                 continue
-                
+
     if "cores" in params.keys():
         cv.setNumThreads(params["cores"])
         cores=params["cores"]
     else:
-        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "No multicore informatoin provided setting cores to 1")
+        log("No multicore informatoin provided setting cores to 1")
         cv.setNumThreads(0)
         cores=1
 
+    if "video" not in params.keys() or params["video"] is None:
+        params["video"] = {}
+    if args.use_object_tracking and not params.get("tracking"):
+        params["tracking"] = True
+    check_params(params)
 
-    parsed_videos = {}
-    for file in files:
-        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Parsing frames for " + file)
-        myvid = vid.Video(path=file)
-        if "denoise" in params["video"].keys():
-            denoise = True
-            if "disk" not in params["video"]["denoise"].keys():
-                disk = 2
-            else:
-                disk = params["video"]["denoise"]["disk"]
-        else:
-            denoise = False
-            disk = None
-
-        if params["video"]["invert"]:
-            invert = True
-        else:
-            invert = False
-
-        myvid.get_frames(invert=invert, denoise=denoise, dsk=disk)
-
-        if "adjust" in params["video"].keys():
-            if "method" not in params["video"]["adjust"]:
-                raise ValueError("You did not specify an adjustment algorithm")
-            else:
-                myvid.adjust(method=params["video"]["adjust"]["method"], **params["video"]["adjust"]["method_params"])
-
-        if "normalize" in params["video"]:
-            if "reference_frame" in params["video"]["normalize"]:
-                reference_frame = params["video"]["normalize"]["reference_frame"]
-            else:
-                reference_frame = None
-            myvid.normalize_frames(reference_frame=reference_frame)
-
-        
-        if params["method"] == "object_detection":
-            if "algorithm" not in params["threshold"].keys():
-                raise ValueError("You did not specify a tresholding algorithm")
-            else:
-                seg = obj.Watershed()
-                print("[" + datetime.now().strftime(
-                    "%Y/%m/%d %H:%M:%S") + "] " + "Calculating thresholding valules " + file)
-                seg.threshold(Video=myvid, method=params["threshold"]["algorithm"], cores=cores,
-                              **params["threshold"]["algorithm_params"])
-                print("[" + datetime.now().strftime(
-                    "%Y/%m/%d %H:%M:%S") + "] " + "Performing watershed segmentation " + file)
-                seg.segmentation(Video=myvid, cores=cores, **params["segmentation_params"])
-                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Calculating properties " + file)
-                if "calculate" not in params.keys():
-                    print("Using default values for property calculations see readme for details")
-                    results = seg.properties(Video=myvid, cores=cores)
-                else:
-                    results = seg.properties(Video=myvid, cores=cores, **params["calculate"])
-
-        elif params["method"] == "movement_detection":
-            movement = mov.Movement()
-            if "type" not in params.keys():
-                raise ValueError(
-                    "You did not specify a calculation type, it's either background_subtraction or optical_flow")
-            elif "algorithm" not in params.keys():
-                raise ValueError("You did not specify an algorithm to use see readme for details")
-            else:
-                if params["type"] == "background_subtraction":
-                    print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Performing background subtraction " + file)
-                    back_sub = movement.background_subtractor(algo=params["algorithm"]["name"],
-                                                              **params["algorithm"]["algo_params"])
-                    movement.movement(myvid, method="background", function=back_sub)
-                    zippedList = list(zip(range(len(myvid.masks)), [mask.sum() for mask in myvid.masks]))
-                    results = pd.DataFrame(zippedList, columns=['frame', 'movement'])
-
-                elif params["type"] == "optical_flow":
-                    print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Performing dense optical flow " + file)
-                    dense=movement.dense_flow(params["algorithm"]["name"], **params["algorithm"]["algo_params"])
-                    movement.movement(myvid, method="optical", function=dense, get=params["algorithm"]["return"])
-                    if params["algorithm"]["return"]=="magnitude":
-                        zippedList = list(zip(range(len(myvid.masks)), [mask.sum() for mask in myvid.masks]))
-                        results = pd.DataFrame(zippedList, columns=['frame', 'total_movement'])
-                    else:
-                        zippedList = list(zip(range(len(myvid.masks)), [mask.sum() for mask in myvid.masks]))
-                        results = pd.DataFrame(zippedList, columns=['frame', 'aggregate_angle'])
-                else:
-                    raise ValueError("type can only be background_subtraction or optical_flow")
-
-        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Preparing results for " + file)
-        filename=file.split("/").pop()
-        filename=filename.replace(args.extension, "")
-        filename=filename.replace(" ", "")
-
-        resultsdir = os.path.abspath(args.output) + "/" + filename
-        os.makedirs(resultsdir, exist_ok=True)
-        with pd.ExcelWriter(resultsdir + "/results.xlsx") as writer:
-            results.to_excel(writer, sheet_name="properties", index=False)
-
-        if "output" in params.keys():
-            if "video" in params["output"]:
-                vidname = resultsdir + "/results.mp4"
-                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Generating mp4 for " + file)
-                if "size" not in params["output"]["video"].keys():
-                    size = (6, 3)
-                else:  # this will give a key error is the user messes up so I'm going to leave it
-                    size = (params["output"]["video"]["size"]["width"], 
-                                   params["output"]["video"]["size"]["height"])
-
-                if "FPS" not in params["output"]["video"].keys():
-                    FPS = 10
-                else:
-                    FPS = params["output"]["video"]["FPS"]
-
-                if "periodicity" not in params['output']["video"].keys():
-                    period = 30
-                else:
-                    period = params["output"]["video"]["periodicity"]
-
-                myvid.write_mp4(output=vidname, size=size, FPS=FPS, period=period)
-                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Done analyzing " + file)
-            
-            if "raw" in params["output"]:
-                rawname=resultsdir+"/raw_data.hdf5"
-                myvid.write_raw(rawname)
-
-        shutil.copy(args.config_yaml, resultsdir + "/config.yaml")
-        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + file + " done!")
+    batch = params.get("batch") or {}
+    jobs = args.jobs if args.jobs is not None else batch.get("jobs")
+    memory = args.memory if args.memory is not None else batch.get("memory")
+    if memory is not None:
+        memory = int(memory * 2 ** 30)
+    summary = schedule(files, params, cores, args.output, args.config_yaml, args.extension, jobs=jobs, memory=memory)
+    if len(files) > 1:
+        os.makedirs(args.output, exist_ok=True)
+        summary.to_csv(os.path.abspath(args.output) + "/summary.csv", index=False)
+        print(summary.drop(columns="error").to_string(index=False))
+        # one table for the whole batch partitioned by video
+        for file in summary[summary["status"] == "done"]["file"]:
+            name = video_name(file, args.extension)
+            for extension in EXTENSIONS.values():
+                path = os.path.abspath(args.output) + "/" + name + "/results." + extension
+                if os.path.isfile(path):
+                    add_partition(os.path.abspath(args.output) + "/dataset", name, path)
+    failed = summary[summary["status"] != "done"]
+    log(str(len(summary) - len(failed)) + " of " + str(len(summary)) + " files done")
+    for file, error in zip(failed["file"], failed["error"]):
+        log(file + " failed: " + error.strip().split("\n")[-1])
+    if len(failed) > 0:
+        raise SystemExit(1)
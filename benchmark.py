@@ -0,0 +1,355 @@
+import argparse as arg
+import os
+import sys
+import time
+import tempfile
+import datetime
+import cv2 as cv
+import numpy as np
+import pandas as pd
+import utils
+from movement import Movement
+from object import Watershed
+from video import Video
+from skimage.measure import regionprops_table, label
+
+
+# grayscale frames with a bright ellipse on a darker noisy background, similar to a gut slice
+def synthetic_frames(n, height, width, noise=10, seed=0):
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:height, :width]
+    frames = np.empty((n, height, width), dtype=np.uint8)
+    for i in range(n):
+        cy = height / 2 + height / 12 * np.sin(i / 10)
+        cx = width / 2 + width / 10 * np.cos(i / 15)
+        inside = ((yy - cy) / (height / 5)) ** 2 + ((xx - cx) / (width / 4.5)) ** 2 < 1
+        frame = 60 + 120 * inside + rng.normal(0, noise, (height, width))
+        frames[i] = np.clip(frame, 0, 255)
+    return frames
+
+
+def timeit(func, repeats=3):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def denoise_benchmark(sizes, n=20, cores=1, dsk=2, window=3, repeats=3):
+    rows = []
+    for height, width in sizes:
+        frames = synthetic_frames(n, height, width)
+        for method in utils.DENOISE_METHODS:
+            for pool in ["process", "thread"]:
+                if cores == 1 and pool == "thread":
+                    continue
+                elif cores > 1 and method == "temporal" and pool == "process":
+                    continue  # temporal always uses threads
+                seconds = timeit(lambda: utils.denoise_frames(frames, method=method, dsk=dsk, window=window,
+                                                              cores=cores, pool=pool), repeats=repeats)
+                rows.append({"stage": "denoise", "method": method, "pool": pool, "cores": cores,
+                             "height": height, "width": width, "frames": n, "seconds": seconds,
+                             "fps": n / seconds})
+    return pd.DataFrame(rows)
+
+
+# the per label implementation of calculate_properties before the single pass version, kept for comparison
+def reference_properties(mask, image, properties=None, to_cache=True, min_size=20000, get_largest=False):
+    labels = label(mask)
+    intensities = []
+    for lab in np.unique(labels):
+        if lab == 0:
+            continue
+        intensities.append(np.sum(image[labels == lab]))
+    properties = ["label"] + [prop for prop in properties if prop != "label"]
+    attrs = pd.DataFrame(regionprops_table(label_image=labels, intensity_image=image, properties=properties,
+                                           cache=to_cache))
+    attrs.insert(1, "intensities", intensities)
+    if not get_largest:
+        attrs = attrs[attrs["area"] > min_size]
+    else:
+        attrs = attrs[attrs["area"] == attrs["area"].max()]
+    return attrs
+
+
+# a two class mask with about regions blobs like an over segmented watershed result
+def synthetic_mask(height, width, regions, seed=0):
+    rng = np.random.RandomState(seed)
+    mask = np.ones((height, width), dtype=np.int32)
+    radius = max(int(np.sqrt(height * width / (regions * 8))), 1)
+    yy, xx = np.ogrid[:height, :width]
+    for y, x in zip(rng.randint(0, height, regions), rng.randint(0, width, regions)):
+        mask[(yy - y) ** 2 + (xx - x) ** 2 <= radius ** 2] = 2
+    return mask
+
+
+def properties_benchmark(sizes, regions=(10, 100, 500), min_size=200, repeats=3,
+                         properties=("area", "eccentricity", "solidity", "perimeter")):
+    rows = []
+    for height, width in sizes:
+        image = synthetic_frames(1, height, width)[0]
+        for count in regions:
+            mask = synthetic_mask(height, width, count)
+            old = reference_properties(mask, image, properties=list(properties), min_size=min_size)
+            new = utils.calculate_properties(mask, image, properties=list(properties), min_size=min_size)
+            difference = np.abs(old.values - new.values).max() if len(old) > 0 else 0
+            for name, func in [("per_label", reference_properties), ("single_pass", utils.calculate_properties)]:
+                seconds = timeit(lambda: func(mask, image, properties=list(properties), min_size=min_size),
+                                 repeats=repeats)
+                rows.append({"stage": "properties", "method": name, "height": height, "width": width,
+                             "regions": int(label(mask).max()), "kept": len(new), "seconds": seconds,
+                             "max_difference": difference})
+    return pd.DataFrame(rows)
+
+
+# compares the sharded background subtraction to the serial one for several overlaps, identical is the fraction
+# of pixels with the same value and iou the intersection over union of the foreground pixels
+def background_report(frames, algo="MOG2", cores=1, shards=None, overlaps=(0, 25, 50, 100, 200), repeats=1,
+                      **kwargs):
+    movement = Movement()
+    serial = None
+
+    def run_serial():
+        nonlocal serial
+        serial = movement.movement(None, method="background", function=movement.background_subtractor(algo, **kwargs),
+                                   frames=frames, inplace=False).array
+
+    serial_seconds = timeit(run_serial, repeats=repeats)
+    serial_sums = serial.sum(axis=(1, 2), dtype=np.float64)
+    rows = [{"stage": "background", "method": "serial", "algo": algo, "cores": 1, "shards": 1, "overlap": 0,
+             "frames": len(frames), "seconds": serial_seconds, "speedup": 1.0, "identical": 1.0, "iou": 1.0,
+             "correlation": 1.0}]
+    for overlap in overlaps:
+        sharded = None
+
+        def run_sharded():
+            nonlocal sharded
+            sharded = movement.sharded_background(frames=frames, algo=algo, cores=cores, shards=shards,
+                                                  overlap=overlap, inplace=False, **kwargs).array
+
+        seconds = timeit(run_sharded, repeats=repeats)
+        foreground = serial > 0
+        sharded_foreground = sharded > 0
+        union = np.logical_or(foreground, sharded_foreground).sum()
+        iou = np.logical_and(foreground, sharded_foreground).sum() / union if union > 0 else 1.0
+        sums = sharded.sum(axis=(1, 2), dtype=np.float64)
+        if serial_sums.std() > 0 and sums.std() > 0:
+            correlation = np.corrcoef(serial_sums, sums)[0, 1]
+        else:
+            correlation = float(np.array_equal(serial_sums, sums))
+        rows.append({"stage": "background", "method": "sharded", "algo": algo, "cores": cores,
+                     "shards": cores if shards is None else shards, "overlap": overlap, "frames": len(frames),
+                     "seconds": seconds, "speedup": serial_seconds / seconds, "identical": (serial == sharded).mean(),
+                     "iou": iou, "correlation": correlation})
+    return pd.DataFrame(rows)
+
+
+# bright blobs that move around the frame and change their size and shape over time on a darker background with
+# gaussian noise, one frame at a time so long videos do not have to fit in memory
+def deforming_frames(n, height, width, blobs=5, noise=10, seed=0):
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:height, :width]
+    centers = rng.uniform(0.2, 0.8, (blobs, 2)) * [height, width]
+    radii = rng.uniform(0.05, 0.12, blobs) * min(height, width)
+    speeds = rng.uniform(0.02, 0.1, (blobs, 2))
+    phases = rng.uniform(0, 2 * np.pi, (blobs, 3))
+    for i in range(n):
+        frame = np.full((height, width), 60.0)
+        for b in range(blobs):
+            cy = centers[b, 0] + height / 8 * np.sin(speeds[b, 0] * i + phases[b, 0])
+            cx = centers[b, 1] + width / 8 * np.cos(speeds[b, 1] * i + phases[b, 1])
+            # the blobs contract and stretch like a gut slice
+            stretch = 1 + 0.3 * np.sin(0.15 * i + phases[b, 2])
+            ry, rx = radii[b] * stretch, radii[b] / stretch
+            frame += 120 * np.exp(-(((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2) ** 2)
+        frame += rng.normal(0, noise, (height, width))
+        yield np.clip(frame, 0, 255).astype(np.uint8)
+
+
+# a grayscale avi with a lossless codec so the decoded frames are the generated ones
+def write_synthetic_video(path, n=100, height=480, width=640, FPS=10, **kwargs):
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"FFV1"), FPS, (width, height), isColor=False)
+    if not writer.isOpened():
+        raise IOError("could not open " + path + " for writing")
+    for frame in deforming_frames(n, height, width, **kwargs):
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+# times every stage of the pipeline on a video at 1 to cores cores, the stages run on the output of the previous one
+# like in analysis.py. The writers do not use more than one core so they are only timed once
+def pipeline_benchmark(path, cores=1, repeats=3, threshold_method="otsu", properties=("area", "eccentricity"),
+                       min_size=200):
+    rows = []
+    myvid = Video(path=path)
+    myvid.get_frames()
+    n = len(myvid.frames)
+    height, width = myvid.frames.shape[1:]
+    directory = tempfile.mkdtemp()
+
+    def add(stage, method, used, func):
+        seconds = timeit(func, repeats=repeats)
+        rows.append({"stage": stage, "method": method, "cores": used, "height": height, "width": width,
+                     "frames": n, "seconds": seconds, "fps": n / seconds})
+        print(stage, method, used, "cores:", round(seconds, 3), "seconds")
+
+    for used in range(1, cores + 1):
+        # get_frames releases the capture so every repeat opens the video again
+        add("get_frames", "decode", used, lambda: Video(path=path).get_frames(inplace=False, cores=used))
+        adjusted = myvid.adjust("gamma", inplace=False, cores=used, gain=1)
+        add("adjust", "gamma", used, lambda: myvid.adjust("gamma", inplace=False, cores=used, gain=1))
+        # the watershed needs integer frames
+        normalized = myvid.normalize_frames(frames=adjusted, inplace=False, reference_frame=0, dtype="uint8",
+                                            cores=used)
+        add("normalize_frames", "match", used,
+            lambda: myvid.normalize_frames(frames=adjusted, inplace=False, reference_frame=0, dtype="uint8",
+                                           cores=used))
+        with Watershed(used) as watershed:
+            thresholds = watershed.threshold(frames=normalized, method=threshold_method, cores=used, inplace=False)
+            add("threshold", threshold_method, used,
+                lambda: watershed.threshold(frames=normalized, method=threshold_method, cores=used, inplace=False))
+            masks = watershed.segmentation(frames=normalized, threshold=thresholds, cores=used, inplace=False)
+            add("segmentation", "watershed", used,
+                lambda: watershed.segmentation(frames=normalized, threshold=thresholds, cores=used, inplace=False))
+            add("properties", "regionprops", used,
+                lambda: watershed.properties(masks=masks, frames=normalized, cores=used, properties=list(properties),
+                                             min_size=min_size))
+        with Movement(used) as movement:
+            add("movement", "MOG2", used,
+                lambda: movement.sharded_background(frames=normalized, algo="MOG2", cores=used, inplace=False))
+            add("optical_flow", "farnebeck", used,
+                lambda: movement.optical_flow(frames=normalized, algo="farnebeck", cores=used, inplace=False))
+
+    def write_raw():
+        output = os.path.join(directory, "raw.h5")
+        if os.path.isfile(output):
+            os.remove(output)
+        myvid.write_raw(output, frames=None, masks=masks, thresholds=thresholds)
+
+    add("write_raw", "gzip", 1, write_raw)
+    add("write_mp4", "opencv", 1, lambda: myvid.write_mp4(os.path.join(directory, "video.mp4"), masks=masks,
+                                                          period=1))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return pd.DataFrame(rows)
+
+
+# the other columns of a benchmark, e.g. stage, method, cores and size, identify what was measured
+MEASURES = ["seconds", "fps", "speedup", "identical", "iou", "correlation", "max_difference", "kept"]
+
+
+# every run is appended to a csv file with its date and label so the runs can be compared later
+def save_results(results, path, benchmark, label=None):
+    results = results.copy()
+    results.insert(0, "benchmark", benchmark)
+    results.insert(0, "label", label if label is not None else "")
+    results.insert(0, "run", datetime.datetime.now().isoformat(timespec="seconds"))
+    if os.path.isfile(path):
+        results = pd.concat([pd.read_csv(path), results], ignore_index=True)
+    results.to_csv(path, index=False)
+    return results
+
+
+# compares a run to the last run in the history (or the last run with label) that has the same stage, method,
+# cores, size etc. A stage is a regression when it takes more than 1 + threshold times as long as before
+def compare_results(results, history, benchmark, threshold=0.2, label=None):
+    if isinstance(history, str):
+        history = pd.read_csv(history)
+    if label is not None:
+        history = history[history["label"] == label]
+    history = history[history["benchmark"] == benchmark]
+    keys = [column for column in results.columns if column not in MEASURES]
+    if len(history) == 0 or any(key not in history.columns for key in keys):
+        # nothing to compare to yet
+        compared = results.copy()
+        compared["baseline_seconds"] = np.nan
+    else:
+        baseline = history.sort_values("run").groupby(keys, as_index=False).last()[keys + ["seconds"]]
+        compared = results.merge(baseline.rename(columns={"seconds": "baseline_seconds"}), on=keys, how="left")
+    compared["ratio"] = compared["seconds"] / compared["baseline_seconds"]
+    compared["regression"] = compared["ratio"] > 1 + threshold
+    return compared
+
+
+def parse_sizes(sizes):
+    parsed = []
+    for size in sizes.split(","):
+        height, width = size.lower().split("x")
+        parsed.append((int(height), int(width)))
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = arg.ArgumentParser(description='benchmark the video processing steps on synthetic frames')
+    parser.add_argument('-b', '--benchmark', type=str, help='denoise, properties, background or pipeline', action="store",
+                        default="denoise")
+    parser.add_argument('-s', '--sizes', type=str, help='frame sizes as heightxwidth separated by commas',
+                        action="store", default="240x320,480x640,1080x1920")
+    parser.add_argument('-n', '--frames', type=int, help='number of frames per size', action="store", default=20)
+    parser.add_argument('-c', '--cores', type=int, help='number of processes or threads', action="store",
+                        default=1)
+    parser.add_argument('-f', '--file', type=str, help='video file for the background benchmark, default is a '
+                                                       'synthetic video', action="store", default=None)
+    parser.add_argument('-a', '--algorithm', type=str, help='background subtractor for the background benchmark',
+                        action="store", default="MOG2")
+    parser.add_argument('-o', '--overlaps', type=str, help='overlaps for the background benchmark separated by '
+                                                           'commas', action="store", default="0,25,50,100,200")
+    parser.add_argument('-l', '--length', type=int, help='number of frames of the synthetic video for the pipeline '
+                                                         'benchmark', action="store", default=100)
+    parser.add_argument('--history', type=str, help='csv file the results are appended to and compared with',
+                        action="store", default=None)
+    parser.add_argument('--label', type=str, help='label of this run in the history, e.g. a version',
+                        action="store", default=None)
+    parser.add_argument('--baseline', type=str, help='compare to the last run with this label instead of the last run',
+                        action="store", default=None)
+    parser.add_argument('--threshold', type=float, help='slowdown that is flagged as a regression, 0.2 is 20%% slower',
+                        action="store", default=0.2)
+    parser.add_argument('-r', '--repeats', type=int, help='number of repeats, the fastest is reported',
+                        action="store", default=3)
+    args = parser.parse_args()
+
+    if args.benchmark == "denoise":
+        results = denoise_benchmark(parse_sizes(args.sizes), n=args.frames, cores=args.cores, repeats=args.repeats)
+    elif args.benchmark == "properties":
+        results = properties_benchmark(parse_sizes(args.sizes), repeats=args.repeats)
+    elif args.benchmark == "background":
+        if args.file is None:
+            height, width = parse_sizes(args.sizes)[0]
+            frames = synthetic_frames(args.frames, height, width)
+        else:
+            myvid = Video(path=args.file)
+            myvid.get_frames()
+            frames = myvid.frames
+        overlaps = [int(overlap) for overlap in args.overlaps.split(",")]
+        results = background_report(frames, algo=args.algorithm, cores=args.cores, overlaps=overlaps,
+                                    repeats=args.repeats)
+    elif args.benchmark == "pipeline":
+        if args.file is None:
+            tables = []
+            for height, width in parse_sizes(args.sizes):
+                with tempfile.TemporaryDirectory() as directory:
+                    path = write_synthetic_video(os.path.join(directory, "synthetic.avi"), n=args.length,
+                                                 height=height, width=width)
+                    tables.append(pipeline_benchmark(path, cores=args.cores, repeats=args.repeats))
+            results = pd.concat(tables, ignore_index=True)
+        else:
+            results = pipeline_benchmark(args.file, cores=args.cores, repeats=args.repeats)
+    else:
+        raise ValueError("benchmark can be denoise, properties, background or pipeline")
+    print(results.to_string(index=False))
+
+    if args.history is not None:
+        regressions = 0
+        if os.path.isfile(args.history):
+            compared = compare_results(results, args.history, args.benchmark, threshold=args.threshold,
+                                       label=args.baseline)
+            regressions = int(compared["regression"].sum())
+            print(compared[[column for column in compared.columns if column not in MEASURES[1:]]].to_string(index=False))
+            print(regressions, "regressions slower than", 1 + args.threshold, "times the baseline")
+        save_results(results, args.history, args.benchmark, label=args.label)
+        if regressions > 0:
+            sys.exit(1)
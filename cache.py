@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import h5py
+
+try:
+    import fcntl
+except ImportError:
+    # windows, the hashes of parallel videos can then overwrite each other
+    fcntl = None
+
+# changing this invalidates all the cached results, e.g. when a stage gives different results than before
+CACHE_VERSION = 1
+
+
+# results of the pipeline stages on disk, each entry is an hdf5 file named after the hash of the video and the
+# parameters of every stage up to and including this one, so changing a parameter only misses the stages after it.
+# Compressed entries are stored in chunks of one frame, with compression=None the arrays are stored contiguously and
+# are memory mapped when they are read. When the cache is larger than max_size bytes the least recently used entries
+# are deleted
+class StageCache:
+    def __init__(self, directory, max_size=None, compression="lzf"):
+        self.directory = directory
+        self.max_size = max_size
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+
+    # hashing a long video takes a while so the hash is kept with the size and modification time of the file. The
+    # videos of a batch are analysed in parallel with the same cache so hashes.json is updated under a lock and
+    # replaced in one step, a reader never sees a half written file
+    def file_hash(self, path):
+        stat = os.stat(path)
+        name = os.path.abspath(path)
+        hashes = self.hashes()
+        if name in hashes and hashes[name]["size"] == stat.st_size and hashes[name]["mtime"] == stat.st_mtime_ns:
+            return hashes[name]["hash"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(block)
+        with open(os.path.join(self.directory, "hashes.lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # the other processes may have added their videos since it was read
+            hashes = self.hashes()
+            hashes[name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+            handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(handle, "w") as f:
+                json.dump(hashes, f)
+            os.replace(temporary, os.path.join(self.directory, "hashes.json"))
+        return hashes[name]["hash"]
+
+    def hashes(self):
+        known = os.path.join(self.directory, "hashes.json")
+        if not os.path.isfile(known):
+            return {}
+        with open(known) as f:
+            return json.load(f)
+
+    # the key of a stage is made from the key of the previous stage, the name and the parameters of this stage
+    def key(self, previous, stage, params=None):
+        text = json.dumps([CACHE_VERSION, previous, stage, params], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".h5")
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    # returns a dictionary of arrays or None if the stage is not cached, the memory mapped arrays are copy on write
+    # so the following stages can still change them in place
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        arrays = {}
+        with h5py.File(path, "r") as f:
+            for name, dataset in f.items():
+                offset = dataset.id.get_offset()
+                if dataset.compression is None and dataset.chunks is None and offset is not None:
+                    arrays[name] = (offset, dataset.shape, dataset.dtype)
+                else:
+                    arrays[name] = dataset[()]
+        for name, array in arrays.items():
+            if isinstance(array, tuple):
+                offset, shape, dtype = array
+                arrays[name] = np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+        os.utime(path)
+        return arrays
+
+    # the file is written under a temporary name first so an interrupted run never leaves a broken entry
+    def put(self, key, **arrays):
+        handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(handle)
+        with h5py.File(temporary, "w") as f:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                if self.compression is not None and array.ndim == 3:
+                    f.create_dataset(name, data=array, chunks=(1,) + array.shape[1:], compression=self.compression)
+                else:
+                    f.create_dataset(name, data=array)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".h5"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for mtime, size, name in self.entries())
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self):
+        for mtime, size, name in self.entries():
+            os.remove(os.path.join(self.directory, name))
@@ -1,10 +1,142 @@
 import numpy as np
 import cv2 as cv
-from video import Video
-from utils import curry
+import pandas as pd
+from video import Video, FrameStore
+from utils import curry, split_range
+from parallel import SharedArray, attach
 from multiprocessing import Pool
 
+
+# runs in a worker process, the subtractor is first trained on the warmup frames before start and their masks
+# are thrown away, then the masks of start to stop are written to the shared mask array
+def background_shard(start, stop, warmup, frames, masks, algo=None, **kwargs):
+    cv.setNumThreads(1)
+    backsub = Movement().background_subtractor(algo, **kwargs)
+    frames = attach(frames)
+    masks = attach(masks, mode="r+")
+    for i in range(max(start - warmup, 0), start):
+        backsub.apply(np.asarray(frames[i]))
+    for i in range(start, stop):
+        masks[i] = backsub.apply(np.asarray(frames[i]))
+    masks.flush()
+
+
+# the flow objects are created once per worker process
+flows = {}
+
+
+def flow_object(algo, **kwargs):
+    key = (algo, tuple(sorted(kwargs.items())))
+    if key not in flows:
+        flows[key] = Movement().dense_flow(algo, **kwargs)
+    return flows[key]
+
+
+# per frame reductions of a flow field, sum is what calculate returns for the same get so the results do not change,
+# the percentiles are of the magnitude and the angle histogram is weighted by the magnitude
+def flow_statistics(mag, ang, get="magnitude", percentiles=(50, 90, 99), bins=8, area=1, roi=None, scale=1):
+    if get == "magnitude":
+        total = mag.sum()
+    elif get == "angle":
+        total = ang.sum()
+    elif get == "both":
+        total = mag.sum() + ang.sum()
+    else:
+        raise ValueError("you can get either magnitude, angle or both")
+    stats = {"sum": total * area, "mean": mag.mean(), "max": mag.max()}
+    for percentile, value in zip(percentiles, np.percentile(mag, percentiles)):
+        stats["p" + str(percentile)] = value
+    if roi is not None:
+        for name, region in roi.items():
+            if get == "magnitude":
+                total = roi_sum(mag, region, scale)
+            elif get == "angle":
+                total = roi_sum(ang, region, scale)
+            else:
+                total = roi_sum(mag, region, scale) + roi_sum(ang, region, scale)
+            stats["roi_" + name] = total * area
+    if bins > 0:
+        edges = np.linspace(0, 180, bins + 1)
+        hist = np.histogram(ang, bins=edges, weights=mag)[0] * area
+        for i in range(bins):
+            stats["angle_" + str(int(edges[i])) + "_" + str(int(edges[i + 1]))] = hist[i]
+    return stats
+
+
+# flow between two frames on the level-th pyramid level, the vectors are scaled back to the original pixel size and
+# the sums are multiplied by the number of pixels each downscaled pixel stands for. Small movements are lost on the
+# downscaled frames so the statistics at level > 0 are approximate and lower than at full resolution
+def flow_pair(frame1, frame2, dense_flow, get="magnitude", level=0, percentiles=(50, 90, 99), bins=8, roi=None,
+              keep=False):
+    if frame1.shape != frame2.shape:
+        raise ValueError("Your video frames are not the same shape")
+    for i in range(level):
+        frame1 = cv.pyrDown(frame1)
+        frame2 = cv.pyrDown(frame2)
+    flow = dense_flow.calc(frame1, frame2, flow=None)
+    mag, ang = cv.cartToPolar(flow[..., 0], flow[..., 1])
+    ang = ang * 180 / np.pi / 2
+    if level > 0:
+        mag *= 2 ** level
+    stats = flow_statistics(mag, ang, get=get, percentiles=percentiles, bins=bins, area=4 ** level,
+                            roi=roi, scale=2 ** level)
+    field = None
+    if keep:
+        if get == "magnitude":
+            field = mag
+        elif get == "angle":
+            field = ang
+        else:
+            field = np.stack([mag, ang], axis=2)
+    return stats, field
+
+
+# runs in a worker process, frame index is compared to index - 1 and only the statistics are sent back unless the
+# field is written to the shared masks
+def flow_shared(index, frames, masks=None, algo=None, algo_params=None, **kwargs):
+    cv.setNumThreads(1)
+    frames = attach(frames)
+    stats, field = flow_pair(np.asarray(frames[index - 1]), np.asarray(frames[index]),
+                             flow_object(algo, **algo_params), keep=masks is not None, **kwargs)
+    if masks is not None:
+        attach(masks, mode="r+")[index] = field
+    return stats
+
+
 class Movement:
+    # with cores > 1 the worker pool can be kept for all the chunks of a streamed video, either call start and close
+    # or use the class as a context manager
+    def __init__(self, cores=1):
+        self.cores = cores
+        self.pool = None
+
+    def start(self, cores=None):
+        if cores is not None:
+            self.cores = cores
+        if self.cores > 1 and self.pool is None:
+            self.pool = Pool(self.cores)
+        return self
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def run(self, cores, func, inputs, chunksize=1):
+        if self.pool is not None:
+            results = self.pool.starmap(func, inputs, chunksize)
+        else:
+            with Pool(cores) as p:
+                results = p.starmap(func, inputs, chunksize)
+        return results
+
     def background_subtractor(self, algo, **kwargs):
         if algo == 'MOG2':
             backSub = cv.createBackgroundSubtractorMOG2(**kwargs)
@@ -47,33 +179,181 @@ class Movement:
                 raise ValueError("you can get either magnitude, angle or both")
 
 
-    def movement(self, Video, method, function, get=None, frames=None, inplace=True):
-        if len(Video.frames) == 0 and frames is None:
+    # the masks are generated one at a time so they can be reduced without keeping them
+    def generate_masks(self, frames, method, function, get=None, previous=None):
+        if method == "background":
+            for frame in frames:
+                yield function.apply(frame)
+        elif method == "optical":
+            if previous is not None:
+                yield self.dense_flow_calculate(previous, frames[0], function, what=get)
+            for i in range(1, len(frames)):
+                mask = self.dense_flow_calculate(frames[i - 1], frames[i], function, what=get)
+                if i == 1 and previous is None:
+                    # the first frame has no movement, the empty mask needs the same shape and type as the flow
+                    yield np.zeros_like(mask)
+                yield mask
+            if len(frames) == 1 and previous is None:
+                yield np.zeros(frames[0].shape, dtype=np.float32)
+        else:
+            raise ValueError("methods can only be 'background' or 'optical'")
+
+    # previous is the last frame of the previous chunk when the frames are streamed, for optical flow
+    # the first mask of the chunk is then calculated against it instead of being all zeros
+    def movement(self, Video, method, function, get=None, frames=None, inplace=True, previous=None):
+        if Video is None and frames is None:
+            raise ValueError("you did not specify any frames")
+        elif Video is None:
+            frames = frames
+        elif len(Video.frames) == 0 and frames is None:
             raise ValueError("you did not specify any frames")
         elif frames is None and len(Video.frames) > 0:
             frames = Video.frames
         elif frames is not None and len(Video.frames) > 0:
             raise ValueError("you specified 2 sets of frames")
 
-        masks = []
-        if method == "background":
-            for frame in frames:
-                mask = function.apply(frame)
-                masks.append(mask)
-        elif method == "optical":
-            masks.append(np.zeros_like(frames[0]))
-            for i in range(1, len(frames)):
-                mask = self.dense_flow_calculate(frames[i - 1], frames[i], function,
-                                                 what=get)
-                masks.append(mask)
-
+        masks = FrameStore(capacity=len(frames))
+        for mask in self.generate_masks(frames, method, function, get=get, previous=previous):
+            masks.append(mask)
+        if inplace and Video is not None:
+            Video.masks = masks
+        elif inplace and Video is None:
+            raise ValueError("did not specify a video class object")
         else:
-            raise ValueError("methods can only be 'background' or 'optical'")
-        if inplace:
+            return masks
+
+    # background subtraction is sequential, here the video is split into shards that each get their own
+    # subtractor in a separate process. Each subtractor is trained on the overlap frames before its shard so its
+    # background model is close to the one the serial subtractor would have at that point
+    def sharded_background(self, Video=None, algo="MOG2", frames=None, cores=1, shards=None, overlap=100,
+                           inplace=True, **kwargs):
+        if Video is None and frames is None:
+            raise ValueError("you did not specify any frames")
+        elif Video is not None and frames is not None and len(Video.frames) > 0:
+            raise ValueError("you specified 2 sets of frames")
+        elif frames is None:
+            frames = Video.frames
+        if len(frames) == 0:
+            raise ValueError("you did not specify any frames")
+        if shards is None:
+            shards = cores
+
+        shared = SharedArray.from_array(frames)
+        shared_masks = SharedArray(shared.shape, np.uint8)
+        try:
+            ranges = [(start, stop, overlap) for start, stop, step in split_range(0, len(frames), 1, shards)]
+            shard = curry(background_shard, frames=shared.spec, masks=shared_masks.spec, algo=algo, **kwargs)
+            if cores > 1:
+                self.run(cores, shard, ranges)
+            else:
+                for inputs in ranges:
+                    shard(*inputs)
+            masks = FrameStore.from_frames(np.array(shared_masks.array))
+        finally:
+            shared.release()
+            shared_masks.release()
+
+        if inplace and Video is not None:
             Video.masks = masks
+        elif inplace and Video is None:
+            raise ValueError("did not specify a video class object")
         else:
             return masks
 
+    # optical flow where each pair of frames is a separate task, every worker has its own flow object. Only the
+    # statistics of each field are returned as a data frame, with keep_fields the fields are also kept as masks.
+    # With level > 0 the flow is calculated on the frames downscaled level times by half. The first frame has no
+    # movement unless previous is given
+    def optical_flow(self, Video=None, algo="farnebeck", frames=None, get="magnitude", cores=1, level=0,
+                     percentiles=(50, 90, 99), bins=8, roi=None, keep_fields=False, previous=None, inplace=True,
+                     **kwargs):
+        if Video is None and frames is None:
+            raise ValueError("you did not specify any frames")
+        elif Video is not None and frames is not None and len(Video.frames) > 0:
+            raise ValueError("you specified 2 sets of frames")
+        elif frames is None:
+            frames = Video.frames
+        if len(frames) == 0:
+            raise ValueError("you did not specify any frames")
+        if get not in ["magnitude", "angle", "both"]:
+            raise ValueError("you can get either magnitude, angle or both")
+
+        if previous is not None:
+            frames = FrameStore.from_frames([previous] + list(frames))
+        options = {"get": get, "level": level, "percentiles": percentiles, "bins": bins, "roi": roi}
+        if cores == 1:
+            dense_flow = self.dense_flow(algo, **kwargs)
+            stats = []
+            fields = []
+            for i in range(1, len(frames)):
+                stat, field = flow_pair(np.asarray(frames[i - 1]), np.asarray(frames[i]), dense_flow,
+                                        keep=keep_fields, **options)
+                stats.append(stat)
+                fields.append(field)
+        else:
+            shared = SharedArray.from_array(frames)
+            shared_masks = None
+            try:
+                if keep_fields:
+                    # pyrDown rounds the size up
+                    shape = shared.shape[1:3]
+                    for i in range(level):
+                        shape = ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+                    if get == "both":
+                        shape = shape + (2,)
+                    shared_masks = SharedArray((len(frames),) + shape, np.float32)
+                stats = self.run(cores, curry(flow_shared, frames=shared.spec,
+                                              masks=None if shared_masks is None else shared_masks.spec,
+                                              algo=algo, algo_params=kwargs, **options),
+                                 [(i,) for i in range(1, len(frames))], max((len(frames) - 1) // (cores * 4), 1))
+                if shared_masks is not None:
+                    fields = list(np.array(shared_masks.array[1:]))
+                else:
+                    fields = [None] * len(stats)
+            finally:
+                shared.release()
+                if shared_masks is not None:
+                    shared_masks.release()
+
+        if previous is None:
+            # the first frame has no movement
+            first = {key: 0.0 for key in stats[0].keys()} if len(stats) > 0 \
+                else flow_statistics(np.zeros((1, 1), dtype=np.float32), np.zeros((1, 1), dtype=np.float32),
+                                     get=get, percentiles=percentiles, bins=bins, roi=roi)
+            stats = [first] + stats
+            if keep_fields:
+                if len(fields) > 0:
+                    fields = [np.zeros_like(fields[0])] + fields
+                else:
+                    fields = [np.zeros(np.asarray(frames[0]).shape[:2], dtype=np.float32)]
+        stats = pd.DataFrame(stats)
+
+        if not keep_fields:
+            return stats
+        masks = FrameStore.from_frames(fields)
+        if inplace and Video is not None:
+            Video.masks = masks
+            return stats
+        elif inplace and Video is None:
+            raise ValueError("did not specify a video class object")
+        else:
+            return stats, masks
+
+    # same as movement but each mask is passed to the reducer and dropped, the reducer is returned and can be passed
+    # again with the next chunk of a streamed video
+    def reduce(self, Video=None, method=None, function=None, get=None, frames=None, reducer=None, previous=None):
+        if Video is None and frames is None:
+            raise ValueError("you did not specify any frames")
+        elif Video is not None and frames is not None and len(Video.frames) > 0:
+            raise ValueError("you specified 2 sets of frames")
+        elif frames is None:
+            frames = Video.frames
+        if reducer is None:
+            reducer = MovementReducer()
+        for mask in self.generate_masks(frames, method, function, get=get, previous=previous):
+            reducer.add(mask)
+        return reducer
+
     # this just sums up all the values, it is not meaningful for angles
     def calculate(self, Video=None, masks=None):
         if Video is not None and masks is not None:
@@ -87,4 +367,67 @@ class Movement:
         for mask in masks:
             sums.append(mask.sum())
 
-        return sums
\ No newline at end of file
+        return sums
+
+
+# the region of interest is either a boolean array or a box as [first row, last row, first column, last column],
+# scale is how many times the mask is smaller than the frames
+def roi_sum(mask, roi, scale=1):
+    if isinstance(roi, np.ndarray):
+        return mask[roi[::scale, ::scale]].sum()
+    y0, y1, x0, x1 = [int(np.ceil(edge / scale)) for edge in roi]
+    return mask[y0:y1, x0:x1].sum()
+
+
+# time series of the masks that are added one at a time, so the memory does not depend on the length of the video.
+# For each mask the total, the number of foreground pixels (above foreground) and the total within each roi are
+# kept. The heatmap is the mean of the masks, with decay it is an exponential moving average that follows the
+# recent movement. With keep every nth mask is kept for the mp4 output. For optical flow with both only the
+# magnitude is used for the foreground and heatmap
+class MovementReducer:
+    def __init__(self, roi=None, foreground=0, heatmap=True, decay=None, keep=None):
+        if roi is None:
+            roi = {}
+        self.roi = roi
+        self.foreground = foreground
+        self.decay = decay
+        self.keep = keep
+        self.totals = []
+        self.counts = []
+        self.roi_totals = {name: [] for name in roi.keys()}
+        self.heat = None if heatmap else False
+        self.kept = []
+
+    def __len__(self):
+        return len(self.totals)
+
+    def add(self, mask):
+        if self.keep is not None and len(self.totals) % self.keep == 0:
+            self.kept.append(mask)
+        self.totals.append(mask.sum())
+        for name, roi in self.roi.items():
+            self.roi_totals[name].append(roi_sum(mask, roi))
+        if mask.ndim == 3:
+            mask = mask[..., 0]
+        self.counts.append(np.count_nonzero(mask > self.foreground))
+        if self.heat is None:
+            self.heat = mask.astype(np.float64)
+        elif self.heat is not False and self.decay is None:
+            self.heat += mask
+        elif self.heat is not False:
+            self.heat *= self.decay
+            self.heat += (1 - self.decay) * mask
+
+    @property
+    def heatmap(self):
+        if self.heat is None or self.heat is False:
+            return None
+        elif self.decay is None:
+            return self.heat / len(self.totals)
+        return self.heat
+
+    def results(self):
+        results = pd.DataFrame({"total": self.totals, "foreground": self.counts})
+        for name, totals in self.roi_totals.items():
+            results["roi_" + name] = totals
+        return results
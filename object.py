@@ -1,36 +1,163 @@
 import skimage.filters as filt
 import pandas as pd
 from utils import *
-from video import Video
+from video import Video, FrameStore, PackedMasks
+from parallel import SharedArray, attach
+from tiles import tile_grid, tile_offsets, label_dtype, segment_tile, label_tile, relabel_tile, seam_pairs, \
+    merge_labels, region_order
 from multiprocessing import Pool
 
 
+# these run in the worker processes, the frames and masks are read from shared memory by their index
+def threshold_frame(index, frames, func):
+    return func(np.asarray(attach(frames)[index]))
+
+
+def segment_frame(index, threshold, frames, masks, **kwargs):
+    attach(masks, mode="r+")[index] = apply_watershed(np.asarray(attach(frames)[index]), threshold, **kwargs)
+
+
+def measure_frame(index, masks, frames, **kwargs):
+    return calculate_properties(np.asarray(attach(masks)[index]), np.asarray(attach(frames)[index]), **kwargs)
+
+
+# threshold, watershed and properties for a single frame, the mask is only returned if it is needed and
+# can be downsampled by taking every nth pixel
+def detect_frame(frame, thresh_func=None, threshold=None, keep_mask=False, downsample=1, segmentation_params=None,
+                 properties_params=None):
+    if threshold is None:
+        threshold = thresh_func(frame)
+    mask = apply_watershed(frame, threshold, **segmentation_params)
+    measures = calculate_properties(mask, frame, **properties_params)
+    if keep_mask:
+        mask = mask[::downsample, ::downsample].copy()
+    else:
+        mask = None
+    return threshold, measures, mask
+
+
+def detect_shared(index, keep_mask, threshold, frames, **kwargs):
+    return detect_frame(np.asarray(attach(frames)[index]), threshold=threshold, keep_mask=keep_mask, **kwargs)
+
+
+def threshold_function(method, **kwargs):
+    if method == "isodata":
+        thresh_func = curry(filt.threshold_isodata, **kwargs)
+    elif method == "li":
+        thresh_func = curry(filt.threshold_li, **kwargs)
+    elif method == "otsu":
+        thresh_func = curry(filt.threshold_otsu, **kwargs)
+    elif method == "yen":
+        thresh_func = curry(filt.threshold_yen, **kwargs)
+    elif method == "multi_otsu":
+        thresh_func = curry(filt.threshold_multiotsu, **kwargs)
+    else:
+        raise ValueError("method can be 'isodata', 'li', "
+                         "'otsu', 'multi_otsu' or 'yen")
+    return thresh_func
+
+
 class Watershed:
-    def threshold(self, Video=None, frames=None, method=None, cores=1, inplace=True, **kwargs):
-        if method == "isodata":
-            thresh_func = curry(filt.threshold_isodata, **kwargs)
-        elif method == "li":
-            thresh_func = curry(filt.threshold_li, **kwargs)
-        elif method == "otsu":
-            thresh_func = curry(filt.threshold_otsu, **kwargs)
-        elif method == "yen":
-            thresh_func = curry(filt.threshold_yen, **kwargs)
-        elif method == "multi_otsu":
-            thresh_func = curry(filt.threshold_multiotsu, **kwargs)
+    # with cores > 1 the same worker pool can be used for threshold, segmentation and properties, either
+    # call start and close or use the class as a context manager
+    def __init__(self, cores=1):
+        self.cores = cores
+        self.pool = None
+        self.shared = []
+        self.temporal_state = None
+        self.warned = False
+
+    def start(self, cores=None):
+        if cores is not None:
+            self.cores = cores
+        if self.cores > 1 and self.pool is None:
+            self.pool = Pool(self.cores)
+        return self
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.release()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # frames and masks are copied to shared memory once and reused by the following stages
+    def share(self, frames):
+        for source, shared in self.shared:
+            if source is frames:
+                return shared
+        shared = SharedArray.from_array(frames)
+        self.shared.append((frames, shared))
+        return shared
+
+    # the masks are returned in the shared memory they were written to instead of a copy, it is kept for the
+    # properties until release. Releasing only removes the file, the memory is freed when the masks are not used
+    # anymore. Packed masks are copied since they are 8 times smaller
+    def masks_from_shared(self, shared_masks, packed=False):
+        if packed:
+            masks = PackedMasks.from_frames(shared_masks.array)
+            shared_masks.release()
+            return masks
+        masks = FrameStore.from_frames(shared_masks.array.view(np.ndarray))
+        self.shared.append((masks, shared_masks))
+        return masks
+
+    def release(self):
+        for source, shared in self.shared:
+            shared.release()
+        self.shared = []
+
+    def run(self, cores, func, inputs):
+        chunksize = max(len(inputs) // (cores * 4), 1)
+        if cores == 1 and self.pool is None:
+            # the tiles are also used with a single core to keep the memory of each step small
+            results = [func(*args) for args in inputs]
+        elif self.pool is not None:
+            results = self.pool.starmap(func, inputs, chunksize)
         else:
-            raise ValueError("method can be 'isodata', 'li', "
-                             "'otsu', 'multi_otsu' or 'yen")
+            with Pool(cores) as p:
+                results = p.starmap(func, inputs, chunksize)
+        return results
+
+    # the histograms are only calculated for 8 bit frames, the thresholds of other frames (e.g. after adjust without
+    # dtype uint8) are calculated from each frame instead
+    def histogram_frames(self, frames, temporal):
+        if temporal and len(frames) > 0 and np.asarray(frames[0]).dtype != np.uint8:
+            if not self.warned:
+                print("Temporal thresholds need 8 bit frames, calculating the threshold of each frame instead")
+                self.warned = True
+            return False
+        return temporal
+
+    # with temporal the thresholds are calculated from the histograms of the frames, Li's method starts from the
+    # threshold of the previous frame and with drift the threshold is only recalculated when the histogram has
+    # changed. The last histogram and threshold are kept so the next chunk of a streamed video continues from them
+    def threshold(self, Video=None, frames=None, method=None, cores=1, inplace=True, temporal=False, drift=None,
+                  **kwargs):
+        thresh_func = threshold_function(method, **kwargs)
 
         if frames is None and Video is not None:
             frames = Video.frames
 
-        if cores == 1:
+        if self.histogram_frames(frames, temporal):
+            markers, self.temporal_state = temporal_thresholds(frames, method, drift=drift,
+                                                               state=self.temporal_state, **kwargs)
+        elif cores == 1:
             markers = []
             for frame in frames:
                 markers.append(thresh_func(frame))
         else:
-            with Pool(cores) as p:
-                markers = p.map(thresh_func, frames)
+            shared = self.share(frames)
+            markers = self.run(cores, curry(threshold_frame, frames=shared.spec, func=thresh_func),
+                               [(i,) for i in range(len(frames))])
+            if self.pool is None:
+                self.release()
 
         if inplace and Video is not None:
             Video.threshold = markers
@@ -39,7 +166,10 @@ class Watershed:
         else:
             return markers
 
-    def segmentation(self, Video=None, frames=None, threshold=None, inplace=True, cores=1, **kwargs):
+    # with tile every frame is split into tiles of tile pixels (an int or (height, width)) that are segmented in
+    # parallel, see segment_tiles. With packed the masks are kept with one bit per pixel, see PackedMasks
+    def segmentation(self, Video=None, frames=None, threshold=None, inplace=True, cores=1, tile=None, overlap=32,
+                     packed=False, **kwargs):
         if Video is not None and frames is not None:
             raise ValueError("Provided 2 sets of frames")
         elif Video is not None and frames is None:
@@ -56,16 +186,24 @@ class Watershed:
 
         if len(frames) != len(threshold):
             raise ValueError("your frames and markers are not the same length")
-        if cores == 1:
-            masks = []
+        if tile is not None:
+            masks = self.segment_tiles(frames, threshold, cores, tile, overlap=overlap, packed=packed, **kwargs)
+        elif cores == 1:
+            masks = PackedMasks() if packed else FrameStore(capacity=len(frames))
             for i in range(len(frames)):
                 mask = apply_watershed(frames[i], threshold[i], **kwargs)
                 masks.append(mask)
         else:
-            with Pool(cores) as p:
-                watershed_func = curry(apply_watershed, **kwargs)
-                inputs = zip(frames, threshold)
-                masks = p.starmap(watershed_func, inputs)
+            shared = self.share(frames)
+            # the first mask is calculated here to get the type of the masks
+            first = apply_watershed(np.asarray(frames[0]), threshold[0], **kwargs)
+            shared_masks = SharedArray((len(frames),) + first.shape, first.dtype)
+            shared_masks.array[0] = first
+            self.run(cores, curry(segment_frame, frames=shared.spec, masks=shared_masks.spec, **kwargs),
+                     [(i, threshold[i]) for i in range(1, len(frames))])
+            masks = self.masks_from_shared(shared_masks, packed)
+            if self.pool is None:
+                self.release()
 
         if inplace and Video is not None:
             Video.masks = masks
@@ -74,7 +212,8 @@ class Watershed:
         else:
             return masks
 
-    def properties(self, Video=None, masks=None, frames=None, cores=1, **kwargs):
+    # with tile the regions are labelled and measured in tiles, see measure_tiles
+    def properties(self, Video=None, masks=None, frames=None, cores=1, tile=None, **kwargs):
         if Video is not None and frames is not None:
             raise ValueError("Provided 2 sets of frames")
         elif Video is not None and frames is None:
@@ -96,16 +235,178 @@ class Watershed:
         if len(frames) != len(masks):
             raise ValueError("The number of masks and frames are not the same!")
 
-        if cores > 1:
-            with Pool(cores) as p:
-                calc_props = curry(calculate_properties, **kwargs)
-                inputs = zip(masks, frames)
-                measures = p.starmap(calc_props, inputs)
+        if tile is not None:
+            temporary = self.pool is None
+            self.start(cores)
+            shared_frames = self.share(frames)
+            shared_masks = self.share(masks)
+            grid = tile_grid(shared_frames.shape[1:], tile)
+            labels = SharedArray(shared_frames.shape[1:], label_dtype(shared_frames.shape[1:]))
+            measures = []
+            for i in range(len(masks)):
+                measures.append(self.measure_tiles(i, shared_frames, shared_masks, labels, grid, cores, **kwargs))
+            labels.release()
+            if temporary:
+                self.close()
+        elif cores > 1:
+            shared_frames = self.share(frames)
+            shared_masks = self.share(masks)
+            measures = self.run(cores, curry(measure_frame, masks=shared_masks.spec, frames=shared_frames.spec,
+                                             **kwargs),
+                                [(i,) for i in range(len(masks))])
+            if self.pool is None:
+                self.release()
         else:
             measures = []
             for i in range(len(masks)):
                 measure = calculate_properties(masks[i], frames[i], **kwargs)
                 measures.append(measure)
 
+        for i in range(len(measures)):
+            measures[i].insert(0, "frame", i)
         measures = pd.concat(measures, ignore_index=True)
         return measures
+
+    # each tile is segmented with overlap extra pixels on every side so the watershed sees (almost) the same
+    # neighbourhood as on the whole frame, only the inner part of the tile is kept. The tiles of all the frames are
+    # segmented at once so a single frame can use all the cores and each worker only holds a tile
+    def segment_tiles(self, frames, threshold, cores, tile, overlap=32, packed=False, **kwargs):
+        temporary = self.pool is None
+        self.start(cores)
+        shared = self.share(frames)
+        grid = tile_grid(shared.shape[1:], tile, overlap)
+        shared_masks = SharedArray(shared.shape, np.uint8)
+        self.run(cores, curry(segment_tile, frames=shared.spec, masks=shared_masks.spec, **kwargs),
+                 [(i, core, outer, threshold[i]) for i in range(len(frames)) for core, outer in grid])
+        masks = self.masks_from_shared(shared_masks, packed)
+        if temporary:
+            self.close()
+        return masks
+
+    # the tiles of a frame are labelled in parallel and the labels that touch across the seams between the tiles are
+    # merged, labels are numbered in the same order as label() so the results are the same as calculate_properties
+    # on the whole frame. The areas and intensities are summed from the tiles, only the regions that are kept are
+    # measured with regionprops. With fill_holes the holes are found the same way first, they are the regions of the
+    # background that do not touch the edge of the frame
+    def measure_tiles(self, index, frames, masks, labels, grid, cores, properties=None, to_cache=True,
+                      fill_holes=False, min_size=20000, get_largest=False):
+        offsets = tile_offsets(grid)
+        mode = "regions"
+        if fill_holes:
+            count, regions, found = self.label_tiles(index, None, masks, labels, grid, offsets, cores, "background")
+            holes = np.bincount(regions, weights=found["edge"], minlength=count) == 0
+            self.relabel_tiles(labels, grid, offsets, found["counts"], holes[regions].astype(labels.dtype), cores)
+            mode = "filled"
+        count, regions, found = self.label_tiles(index, frames, masks, labels, grid, offsets, cores, mode)
+
+        order = region_order(regions, count, found["first"])
+        areas = np.zeros(count + 1, dtype=np.int64)
+        areas[order] = np.rint(np.bincount(regions, weights=found["areas"], minlength=count)).astype(np.int64)
+        sums = np.zeros(count + 1)
+        sums[order] = np.bincount(regions, weights=found["sums"], minlength=count)
+        keep = keep_regions(areas, min_size=min_size, get_largest=get_largest)
+
+        # the small regions are removed and the others get their label in the whole frame
+        lookup = np.zeros(count + 1, dtype=labels.dtype)
+        lookup[keep] = keep
+        self.relabel_tiles(labels, grid, offsets, found["counts"], lookup[order[regions]], cores)
+        return measure_regions(np.asarray(labels.array), np.asarray(frames.array[index]), sums, keep,
+                               properties=properties, to_cache=to_cache)
+
+    def label_tiles(self, index, frames, masks, labels, grid, offsets, cores, mode):
+        found = self.run(cores, curry(label_tile, index=index, masks=masks.spec, labels=labels.spec,
+                                      frames=None if frames is None else frames.spec, mode=mode),
+                         [(core, offsets[i]) for i, (core, outer) in enumerate(grid)])
+        counts = np.array([count for count, first, areas, sums, edge in found], dtype=np.int64)
+        # regions labels the classes of the mask separately so only pixels of the same class are merged
+        pairs = seam_pairs(labels.array, grid, values=masks.array[index] if mode == "regions" else None,
+                           connectivity=1 if mode == "background" else 2)
+        count, regions = merge_labels(pairs, offsets, counts)
+        found = {"counts": counts,
+                 "first": np.concatenate([first for count, first, areas, sums, edge in found]),
+                 "areas": np.concatenate([areas for count, first, areas, sums, edge in found]),
+                 "sums": None if frames is None else np.concatenate([sums for count, first, areas, sums, edge
+                                                                     in found]),
+                 "edge": np.concatenate([edge for count, first, areas, sums, edge in found])}
+        return count, regions, found
+
+    # values has a value for every label of every tile in the order of the tiles
+    def relabel_tiles(self, labels, grid, offsets, counts, values, cores):
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        self.run(cores, curry(relabel_tile, labels=labels.spec),
+                 [(core, offsets[i], values[starts[i]:starts[i] + counts[i]]) for i, (core, outer) in enumerate(grid)])
+
+    # threshold, segmentation and properties in a single task per frame so the masks of the whole video are never
+    # kept in memory. keep_masks=n keeps the (downsampled) mask of every nth frame, offset is the index of the
+    # first frame when the frames are streamed in chunks. Precalculated thresholds can be passed with thresholds.
+    # With tile the frames are segmented and measured in tiles instead, the masks of frames are then kept until
+    # they are measured. With packed the kept masks are stored with one bit per pixel
+    def detect(self, Video=None, frames=None, method=None, cores=1, inplace=True, threshold_params=None,
+               segmentation_params=None, properties_params=None, keep_masks=None, downsample=1, offset=0,
+               temporal=False, drift=None, thresholds=None, tile=None, overlap=32, packed=False):
+        if Video is not None and frames is not None:
+            raise ValueError("Provided 2 sets of frames")
+        elif Video is not None and frames is None:
+            frames = Video.frames
+        elif Video is None and frames is None:
+            raise ValueError("Did not provide any frames")
+
+        if threshold_params is None:
+            threshold_params = {}
+        if segmentation_params is None:
+            segmentation_params = {}
+        if properties_params is None:
+            properties_params = {}
+
+        thresh_func = threshold_function(method, **threshold_params)
+        if thresholds is not None:
+            # e.g. from the cache of a previous run
+            if len(thresholds) != len(frames):
+                raise ValueError("your frames and thresholds are not the same length")
+        elif self.histogram_frames(frames, temporal):
+            # the histogram thresholds are cheap and depend on the previous frame so they are calculated here
+            thresholds = self.threshold(frames=frames, method=method, inplace=False, temporal=True, drift=drift,
+                                        **threshold_params)
+        elif tile is not None:
+            thresholds = self.threshold(frames=frames, method=method, cores=cores, inplace=False, **threshold_params)
+        else:
+            thresholds = [None] * len(frames)
+        keep = [keep_masks is not None and (offset + i) % keep_masks == 0 for i in range(len(frames))]
+        detect_func = curry(detect_frame, thresh_func=thresh_func, downsample=downsample,
+                            segmentation_params=segmentation_params, properties_params=properties_params)
+        if tile is not None:
+            tiled = self.segmentation(frames=frames, threshold=thresholds, inplace=False, cores=cores, tile=tile,
+                                      overlap=overlap, **segmentation_params)
+            measures = self.properties(masks=tiled, frames=frames, cores=cores, tile=tile, **properties_params)
+            detected = []
+            for i in range(len(frames)):
+                mask = tiled[i][::downsample, ::downsample].copy() if keep[i] else None
+                detected.append((thresholds[i], measures[measures["frame"] == i].drop(columns="frame"), mask))
+        elif cores == 1:
+            detected = []
+            for i in range(len(frames)):
+                detected.append(detect_func(frames[i], threshold=thresholds[i], keep_mask=keep[i]))
+        else:
+            shared = self.share(frames)
+            detected = self.run(cores, curry(detect_shared, frames=shared.spec, thresh_func=thresh_func,
+                                             downsample=downsample, segmentation_params=segmentation_params,
+                                             properties_params=properties_params),
+                                [(i, keep[i], thresholds[i]) for i in range(len(frames))])
+            if self.pool is None:
+                self.release()
+
+        thresholds = [threshold for threshold, measures, mask in detected]
+        masks = [mask for threshold, measures, mask in detected if mask is not None]
+        masks = PackedMasks.from_frames(masks) if packed else FrameStore.from_frames(masks)
+        for i in range(len(detected)):
+            detected[i][1].insert(0, "frame", offset + i)
+        measures = pd.concat([measures for threshold, measures, mask in detected], ignore_index=True)
+
+        if inplace and Video is not None:
+            Video.threshold = thresholds
+            Video.masks = masks
+            return measures
+        elif inplace and Video is None:
+            raise ValueError("did not specify a video class object")
+        else:
+            return measures, thresholds, masks
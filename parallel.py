@@ -0,0 +1,60 @@
+import os
+import tempfile
+import numpy as np
+
+# /dev/shm is memory backed on linux so the shared arrays never touch the disk
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+# an array in a memory mapped file that worker processes can open by its path instead of receiving a pickled
+# copy of every frame, spec is the small tuple that is sent to the workers
+class SharedArray:
+    def __init__(self, shape, dtype):
+        handle, self.path = tempfile.mkstemp(prefix="video_parser_", suffix=".dat", dir=SHARED_DIR)
+        os.close(handle)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.array = np.memmap(self.path, dtype=self.dtype, mode="w+", shape=self.shape)
+
+    @classmethod
+    def from_array(cls, frames, chunk=64):
+        first = np.asarray(frames[0])
+        shared = cls((len(frames),) + first.shape, first.dtype)
+        for start in range(0, len(frames), chunk):
+            stop = min(start + chunk, len(frames))
+            if isinstance(frames, list):
+                shared.array[start:stop] = np.stack(frames[start:stop])
+            else:
+                shared.array[start:stop] = frames[start:stop]
+        return shared
+
+    @property
+    def spec(self):
+        return self.path, self.shape, self.dtype.str
+
+    def release(self):
+        self.array = None
+        # with a single core the worker functions run in this process and attach the array here
+        for key in [key for key in attached if key[0] == self.path]:
+            del attached[key]
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# worker side, the opened arrays are kept so a persistent worker only opens each file once
+attached = {}
+
+
+def attach(spec, mode="r"):
+    path, shape, dtype = spec
+    key = (path, mode)
+    # the arrays of released chunks are removed from /dev/shm, their memory is only freed when they are closed here
+    for stale in [stale for stale in attached if stale[0] != path and not os.path.exists(stale[0])]:
+        del attached[stale]
+    if key not in attached:
+        if len(attached) >= 8:
+            attached.clear()
+        attached[key] = np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+    return attached[key]
@@ -0,0 +1,113 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+# the items of iterable (e.g. the chunks of stream_frames) are produced in a background thread while the previous
+# ones are used. The thread is at most size + 1 items ahead so the memory stays bounded. Decoding and most of the
+# numpy and opencv functions release the GIL so the thread runs alongside the analysis. Errors are raised where the
+# item would have been returned
+def prefetch(iterable, size=2):
+    if size < 1:
+        raise ValueError("size needs to be a positive integer")
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(end)
+        except BaseException as error:
+            put(Failed(error))
+        finally:
+            # a generator is closed in the thread that runs it, e.g. to release the video capture
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                return
+            if isinstance(item, Failed):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+# the writes (results, hdf5, mp4) run in a background thread in the order they are submitted so the next frames are
+# analysed while the files are written. At most size writes wait in the queue, submit blocks until there is room so
+# the frames of the waiting writes do not fill the memory. The futures of the writes since the last take are kept so
+# the errors of the writes of a video can be checked after it is analysed
+class BackgroundWriter:
+    def __init__(self, size=4):
+        if size < 1:
+            raise ValueError("size needs to be a positive integer")
+        self.size = size
+        self.executor = None
+        self.slots = None
+        self.futures = []
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+            self.slots = threading.BoundedSemaphore(self.size)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, function, *args, **kwargs):
+        if self.executor is None:
+            raise ValueError("the writer is not started")
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    # the futures of the writes since the last call
+    def take(self):
+        futures, self.futures = self.futures, []
+        return futures
+
+    # waits for the writes that are still in the queue
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+# raises the first error of the writes
+def check(futures):
+    for future in futures:
+        future.result()
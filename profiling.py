@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import resource
+import functools
+from collections import Counter
+import pandas as pd
+
+# the methods that are timed and the name of their stage in the report
+VIDEO_STAGES = {"get_frames": "decode", "read_frame": "decode", "denoise": "denoise", "adjust": "adjust",
+                "normalize_frames": "normalize", "write_mp4": "render", "write_heatmap": "render", "write_raw": "raw"}
+WATERSHED_STAGES = {"threshold": "threshold", "segmentation": "watershed", "properties": "properties",
+                    "detect": "detect"}
+MOVEMENT_STAGES = {"movement": "movement", "reduce": "movement", "sharded_background": "movement",
+                   "optical_flow": "optical_flow"}
+RESULTS_STAGES = {"append": "results", "close": "results"}
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+# the worker processes of the pools are children of this process, their cpu time and memory are read from /proc on
+# linux. Finished children are included in RUSAGE_CHILDREN so the difference between two calls is the cpu time the
+# workers used in between
+def children():
+    pids = []
+    if not os.path.isdir("/proc"):
+        return pids
+    parent = os.getpid()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/" + pid + "/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append((pid, fields))
+    return pids
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    running = sum((int(fields[11]) + int(fields[12])) / CLOCK_TICKS for pid, fields in children())
+    return usage.ru_utime + usage.ru_stime + running
+
+
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            own = int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is the peak and is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return own + sum(int(fields[21]) * PAGE_SIZE for pid, fields in children())
+
+
+def count_frames(instance, args, kwargs, result):
+    frames = kwargs.get("frames")
+    if frames is not None and hasattr(frames, "__len__"):
+        return len(frames)
+    video = kwargs.get("Video", args[0] if len(args) > 0 and hasattr(args[0], "frames") else None)
+    if video is not None:
+        return len(video.frames)
+    if hasattr(instance, "frames"):
+        return len(instance.frames)
+    return None
+
+
+# wall time, cpu time of this process and of the workers, peak memory (this process and its workers, sampled in a
+# thread every interval seconds) and frames per second of each call of the instrumented methods. Stages that run
+# inside other stages (e.g. threshold in detect) have the outer stage as parent. Stages that run in other threads
+# (e.g. the writes of the background writer) are background stages, they have their own parents and only the cpu time
+# of their thread is counted since the analysis runs at the same time. With profile one stage is profiled, either
+# with cProfile or by sampling the stack of the thread that started it, the result is written next to the report.
+# The memory is sampled in a thread that only runs while there are stages
+class Profiler:
+    def __init__(self, cores=1, interval=0.1, profile=None, mode="cprofile", sample_interval=0.005):
+        if mode not in ["cprofile", "sample"]:
+            raise ValueError("mode can be 'cprofile' or 'sample'")
+        self.cores = cores
+        self.interval = interval
+        self.profile = profile
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.records = []
+        # the running stages of all threads for the memory, the stack of each thread for the parents
+        self.active = []
+        self.local = threading.local()
+        self.profiler = cProfile.Profile() if profile is not None and mode == "cprofile" else None
+        self.samples = Counter()
+        self.sampling = False
+        self.sampled = None
+        self.depth = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.closing = False
+        self.thread = None
+        # wakes the thread up when sampling starts or the profiler is closed
+        self.wake = threading.Event()
+
+    # the thread stops when no stage is running and is started again by the next stage
+    def watch(self):
+        last = 0
+        while True:
+            with self.lock:
+                if self.closing or (len(self.active) == 0 and not self.sampling):
+                    self.thread = None
+                    return
+            if self.sampling:
+                frame = sys._current_frames().get(self.sampled)
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code.co_filename.split("/")[-1] + ":" + frame.f_code.co_name)
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            now = time.perf_counter()
+            if len(self.active) > 0 and now - last >= self.interval:
+                last = now
+                memory = rss()
+                with self.lock:
+                    for record in self.active:
+                        record["peak_rss_mb"] = max(record["peak_rss_mb"], memory / 2 ** 20)
+            self.wake.wait(self.sample_interval if self.sampling else self.interval)
+            self.wake.clear()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def start_stage(self, name):
+        stack = self.stack()
+        background = threading.current_thread() is not threading.main_thread()
+        record = {"stage": name, "parent": stack[-1]["stage"] if len(stack) > 0 else None, "background": background,
+                  "start": time.time() - self.started, "wall_seconds": time.perf_counter(),
+                  "cpu_seconds": time.thread_time() if background else time.process_time(),
+                  "worker_cpu_seconds": 0 if background else children_cpu(), "peak_rss_mb": rss() / 2 ** 20,
+                  "frames": None}
+        stack.append(record)
+        if name == self.profile:
+            # the same stage can run inside itself, e.g. decode while decoding
+            self.depth += 1
+            if self.depth == 1 and self.profiler is not None:
+                self.profiler.enable()
+            elif self.depth == 1:
+                self.sampled = threading.get_ident()
+                self.sampling = True
+                self.wake.set()
+        with self.lock:
+            self.active.append(record)
+            if self.thread is None and not self.closing:
+                self.thread = threading.Thread(target=self.watch, daemon=True)
+                self.thread.start()
+        return record
+
+    def end_stage(self, record, frames=None):
+        if record["stage"] == self.profile:
+            self.depth -= 1
+            if self.depth == 0 and self.profiler is not None:
+                self.profiler.disable()
+            elif self.depth == 0:
+                self.sampling = False
+        record["wall_seconds"] = time.perf_counter() - record["wall_seconds"]
+        if record["background"]:
+            record["cpu_seconds"] = time.thread_time() - record["cpu_seconds"]
+        else:
+            record["cpu_seconds"] = time.process_time() - record["cpu_seconds"]
+            record["worker_cpu_seconds"] = max(children_cpu() - record["worker_cpu_seconds"], 0)
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], rss() / 2 ** 20)
+        record["frames"] = frames
+        record["fps"] = frames / record["wall_seconds"] if frames and record["wall_seconds"] > 0 else None
+        # how busy the cores were, 1 means every core was used for the whole stage
+        record["utilization"] = (record["cpu_seconds"] + record["worker_cpu_seconds"]) / \
+                                (max(record["wall_seconds"], 1e-9) * self.cores)
+        self.stack().remove(record)
+        with self.lock:
+            self.active.remove(record)
+            self.records.append(record)
+
+    def stage(self, name, frames=None):
+        return Stage(self, name, frames)
+
+    # the methods of an instance (a Video, Watershed or Movement) are replaced with timed ones
+    def instrument(self, instance, stages):
+        for method, name in stages.items():
+            if hasattr(instance, method):
+                setattr(instance, method, self.timed(instance, getattr(instance, method), name))
+        return instance
+
+    def timed(self, instance, method, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            record = self.start_stage(name)
+            frames = None
+            try:
+                result = method(*args, **kwargs)
+                frames = count_frames(instance, args, kwargs, result)
+                return result
+            finally:
+                self.end_stage(record, frames)
+        return wrapper
+
+    # times each item of a generator, e.g. the chunks of stream_frames
+    def iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            record = self.start_stage(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.end_stage(record, 0)
+                with self.lock:
+                    self.records.remove(record)
+                return
+            self.end_stage(record, len(item) if hasattr(item, "__len__") else None)
+            yield item
+
+    # one row per stage, the nested stages and the background stages are not added to the total, the share of a
+    # background stage is the part of the run it overlapped
+    def report(self):
+        with self.lock:
+            records = pd.DataFrame(self.records, columns=["stage", "parent", "background", "start", "wall_seconds",
+                                                          "cpu_seconds", "worker_cpu_seconds", "peak_rss_mb",
+                                                          "frames", "fps", "utilization"])
+        if len(records) == 0:
+            return records
+        summary = records.groupby("stage", sort=False).agg(
+            calls=("stage", "size"), background=("background", "all"), wall_seconds=("wall_seconds", "sum"),
+            cpu_seconds=("cpu_seconds", "sum"), worker_cpu_seconds=("worker_cpu_seconds", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"), frames=("frames", "sum")).reset_index()
+        summary["fps"] = (summary["frames"] / summary["wall_seconds"]).where(summary["frames"] > 0)
+        summary["utilization"] = (summary["cpu_seconds"] + summary["worker_cpu_seconds"]) / \
+                                 (summary["wall_seconds"] * self.cores)
+        top = records[records["parent"].isna() & ~records["background"].astype(bool)]
+        summary["share"] = summary["wall_seconds"] / top["wall_seconds"].sum()
+        return summary
+
+    # stops the memory thread, e.g. when a video failed in the middle of a stage
+    def close(self):
+        with self.lock:
+            self.closing = True
+            thread = self.thread
+        self.wake.set()
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            self.closing = False
+            self.thread = None
+
+    def write(self, directory, name="run_report"):
+        self.close()
+        os.makedirs(directory, exist_ok=True)
+        summary = self.report()
+        summary.to_csv(os.path.join(directory, name + ".csv"), index=False)
+        with open(os.path.join(directory, name + ".json"), "w") as f:
+            json.dump({"cores": self.cores, "wall_seconds": time.time() - self.started,
+                       "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                       "stages": json.loads(summary.to_json(orient="records")),
+                       "calls": json.loads(pd.DataFrame(self.records).to_json(orient="records"))}, f, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(directory, self.profile + ".prof"))
+        elif self.profile is not None:
+            # collapsed stacks, flamegraph.pl and speedscope read this format
+            with open(os.path.join(directory, self.profile + ".stacks"), "w") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(stack + " " + str(count) + "\n")
+        return summary
+
+
+class Stage:
+    def __init__(self, profiler, name, frames=None):
+        self.profiler = profiler
+        self.name = name
+        self.frames = frames
+
+    def __enter__(self):
+        self.record = self.profiler.start_stage(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.end_stage(self.record, self.frames)
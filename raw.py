@@ -0,0 +1,174 @@
+import json
+import numpy as np
+import h5py
+
+# the frames and masks are stored as (number of frames, height, width), files without this attribute are from the
+# earlier versions that stored them as (height, width, number of frames)
+LAYOUT = "frame_major"
+
+
+# the smallest integer type that holds all the values of the mask, floats are kept as float32
+def mask_dtype(mask):
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return np.dtype(bool)
+    elif mask.dtype.kind == "f":
+        return np.dtype(np.float32)
+    elif mask.size == 0:
+        return np.dtype(np.uint8)
+    return np.promote_types(np.min_scalar_type(mask.min()), np.min_scalar_type(mask.max()))
+
+
+# frames and masks are appended as they are calculated to resizable datasets that are chunked by chunk frames, so the
+# whole video never has to be in memory and a single frame can be read back without reading the others. The masks
+# are stored in the smallest type that fits, if a later mask does not fit the dataset is copied to a larger type.
+# The parameters of each stage are kept as json in the attributes of the file and the crop of the frames as crop
+class RawWriter:
+    def __init__(self, output, compression="gzip", compression_opts=None, chunk=1, params=None, crop=None):
+        if compression not in ["gzip", "lzf", None]:
+            raise ValueError("compression can be 'gzip', 'lzf' or None")
+        self.file = h5py.File(output, "w-")
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk = chunk
+        self.file.attrs["layout"] = LAYOUT
+        if crop is not None:
+            # the frames and masks are this box [y0, y1, x0, x1] of the video
+            self.file.attrs["crop"] = np.asarray(crop, dtype=np.int64)
+        if params is not None:
+            for stage, values in params.items():
+                self.file.attrs[stage] = json.dumps(values, default=str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        if "frames" not in self.file:
+            return 0
+        return len(self.file["frames"]["frames"])
+
+    def create(self, group, name, shape, dtype):
+        options = {}
+        if self.compression is not None:
+            options["compression"] = self.compression
+            if self.compression_opts is not None:
+                options["compression_opts"] = self.compression_opts
+        return self.file.require_group(group).create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                                             chunks=(self.chunk,) + shape, dtype=dtype, **options)
+
+    def write(self, group, values, dtype=None):
+        values = np.asarray(values)
+        if group not in self.file:
+            dataset = self.create(group, group, values.shape[1:], values.dtype if dtype is None else dtype)
+        else:
+            dataset = self.file[group][group]
+        if dtype is not None and np.promote_types(dataset.dtype, dtype) != dataset.dtype:
+            # the new masks do not fit, copy the dataset to a larger type
+            old = dataset[()]
+            del self.file[group][group]
+            dataset = self.create(group, group, values.shape[1:], np.promote_types(dataset.dtype, dtype))
+            dataset.resize(len(old), axis=0)
+            dataset[:] = old
+        start = len(dataset)
+        dataset.resize(start + len(values), axis=0)
+        dataset[start:] = values
+
+    def append(self, frames, masks=None, thresholds=None):
+        frames = np.asarray(frames)
+        self.write("frames", frames)
+        if masks is not None:
+            if len(masks) != len(frames):
+                raise ValueError("the number frames do not match number of masks")
+            masks = np.asarray(masks)
+            self.write("masks", masks, dtype=mask_dtype(masks))
+        if thresholds is not None:
+            if len(thresholds) != len(frames):
+                raise ValueError("the number frames do not match number of thresholds")
+            self.write("thresholds", np.asarray(thresholds, dtype=np.float64))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# reads ranges of frames, masks and thresholds from a raw file without loading the rest of it. Slices are in frames,
+# e.g. reader.frames[100:200], and always return (number of frames, height, width) arrays
+class RawReader:
+    def __init__(self, path):
+        self.file = h5py.File(path, "r")
+        self.frame_major = self.file.attrs.get("layout") == LAYOUT
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def params(self):
+        return {stage: json.loads(value) for stage, value in self.file.attrs.items() if stage not in ["layout", "crop"]}
+
+    # the box [y0, y1, x0, x1] of the video the frames were cropped to, None for whole frames
+    @property
+    def crop(self):
+        if "crop" not in self.file.attrs:
+            return None
+        return [int(value) for value in self.file.attrs["crop"]]
+
+    def dataset(self, group):
+        if group not in self.file:
+            return None
+        return RawDataset(self.file[group][group], self.frame_major)
+
+    @property
+    def frames(self):
+        return self.dataset("frames")
+
+    @property
+    def masks(self):
+        return self.dataset("masks")
+
+    @property
+    def thresholds(self):
+        return self.dataset("thresholds")
+
+    def read(self, start=0, stop=None, step=1):
+        masks = self.masks
+        return self.frames[start:stop:step], None if masks is None else masks[start:stop:step]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RawDataset:
+    def __init__(self, dataset, frame_major=True):
+        self.dataset = dataset
+        self.frame_major = frame_major
+
+    def __len__(self):
+        if self.frame_major:
+            return self.dataset.shape[0]
+        return self.dataset.shape[-1]
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    def __getitem__(self, index):
+        if self.frame_major:
+            return self.dataset[index]
+        return np.moveaxis(self.dataset[..., index], -1, 0) if isinstance(index, slice) \
+            else self.dataset[..., index]
+
+    def __array__(self, dtype=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
@@ -0,0 +1,140 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXTENSIONS = {"parquet": "parquet", "feather": "feather", "csv": "csv"}
+EXCEL_ROWS = 1048575
+
+
+# frame and label are stored as int32, the other columns keep their type since the type is set by the first rows
+# and e.g. the sum of the intensities of a later frame might not fit in a smaller one
+INDEX_COLUMNS = ["frame", "label"]
+
+
+def compact(results):
+    results = results.copy()
+    for column in INDEX_COLUMNS:
+        if column in results.columns and results[column].dtype.kind in "iu":
+            results[column] = results[column].astype(np.int32)
+    return results
+
+
+# the results of a video are appended to a single table as they are calculated, parquet and feather need pyarrow
+# and csv is used if it is not installed. The type of each column is set by the first rows that are appended. With
+# excel the table is also exported to an excel file when it is closed
+class ResultsSink:
+    def __init__(self, directory, name="results", format="parquet", excel=False):
+        if format not in EXTENSIONS.keys():
+            raise ValueError("format can be 'parquet', 'feather' or 'csv'")
+        if format != "csv" and pa is None:
+            print("Warning: pyarrow is not installed, writing the results as csv instead of " + format)
+            format = "csv"
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.format = format
+        self.excel = excel
+        self.path = os.path.join(directory, name + "." + EXTENSIONS[format])
+        self.writer = None
+        self.schema = None
+        self.columns = None
+        self.rows = 0
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, results):
+        if self.columns is None:
+            self.columns = results
+        if len(results) == 0:
+            return
+        results = compact(results)
+        if self.format == "csv":
+            results.to_csv(self.path, mode="a", header=self.rows == 0, index=False)
+        else:
+            table = pa.Table.from_pandas(results, preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.format == "parquet":
+                    self.writer = pq.ParquetWriter(self.path, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.path, self.schema)
+            else:
+                table = table.cast(self.schema)
+            self.writer.write_table(table)
+        self.rows += len(results)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif self.rows == 0 and not os.path.isfile(self.path):
+            # nothing was found, the table still has the columns
+            empty = pd.DataFrame() if self.columns is None else compact(self.columns.iloc[:0])
+            if self.format == "csv":
+                empty.to_csv(self.path, index=False)
+            elif self.format == "parquet":
+                empty.to_parquet(self.path, index=False)
+            else:
+                empty.reset_index(drop=True).to_feather(self.path)
+        if self.excel:
+            if self.rows > EXCEL_ROWS:
+                print("There are too many rows for an excel file, skipping the excel export")
+            else:
+                with pd.ExcelWriter(os.path.join(self.directory, self.name + ".xlsx")) as writer:
+                    read_results(self.path).to_excel(writer, sheet_name="properties", index=False)
+            self.excel = False
+
+
+def read_results(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    elif path.endswith(".feather"):
+        return pd.read_feather(path)
+    elif path.endswith(".csv"):
+        return pd.read_csv(path)
+    elif path.endswith(".xlsx"):
+        return pd.read_excel(path)
+    raise ValueError("results can be parquet, feather, csv or xlsx files")
+
+
+# the tables of the videos of a batch are put in directory/video=name/ which pyarrow (and spark, duckdb etc.) read as a
+# single table partitioned by video, the files are hard linked when possible instead of copied
+def add_partition(directory, video, path):
+    partition = os.path.join(directory, "video=" + video)
+    os.makedirs(partition, exist_ok=True)
+    target = os.path.join(partition, "part-0" + os.path.splitext(path)[1])
+    if os.path.isfile(target):
+        os.remove(target)
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copy(path, target)
+    return target
+
+
+# the table of all videos in a partitioned directory with a video column
+def read_dataset(directory):
+    tables = []
+    for partition in sorted(os.listdir(directory)):
+        if not partition.startswith("video="):
+            continue
+        for name in sorted(os.listdir(os.path.join(directory, partition))):
+            table = read_results(os.path.join(directory, partition, name))
+            table.insert(0, "video", partition[len("video="):])
+            tables.append(table)
+    if len(tables) == 0:
+        return pd.DataFrame()
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,187 @@
+import os
+import time
+import traceback
+import multiprocessing as mp
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import cv2 as cv
+import video as vid
+from analysis import log, run_file, video_crop, video_params, frame_range, wants_output
+from pipeline import BackgroundWriter
+
+SUMMARY_COLUMNS = ["file", "status", "cores", "seconds", "error"]
+
+
+# a row of the batch summary, failed files are logged with their error
+def summary_row(file, status, cores, seconds, error=""):
+    if status != "done":
+        log(file + " failed")
+        print(error)
+    return {"file": file, "status": status, "cores": cores, "seconds": seconds, "error": error}
+
+
+# the frames of the next video of a batch are read in a background thread while the current one is analysed, this
+# is only used when the frames are not streamed or cached since they are read by the analysis then
+def load_video(file, params):
+    myvid = vid.Video(path=file)
+    crop = video_crop(myvid, params)
+    invert, denoise, disk = video_params(params)
+    start, stop, step = frame_range(params)
+    myvid.get_frames(invert=invert, denoise=denoise, dsk=disk, start=start, stop=stop, step=step, cores=1, crop=crop)
+    return myvid
+
+
+def preload_videos(params, files, estimates, memory):
+    batch = params.get("batch") or {}
+    if not batch.get("prefetch", True) or len(files) < 2 or "chunk_size" in params["video"].keys() \
+            or params.get("cache") is not None:
+        return False
+    # one video is written, one analysed and one read at the same time
+    if memory is not None and 3 * max(estimates.values()) > memory:
+        log("Not reading the next video in the background, there is not enough memory")
+        return False
+    return True
+
+
+# a rough estimate of the memory that is used while a video is analysed, the frames are float64 after adjust or
+# normalize unless the dtype is uint8 and they are copied to shared memory when more than one core is used. The
+# size of an automatic crop is not known before the frames are read so the whole frame is used
+def estimate_memory(file, params, cores=1):
+    capture = cv.VideoCapture(file)
+    count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+    height = int(capture.get(cv.CAP_PROP_FRAME_HEIGHT))
+    width = int(capture.get(cv.CAP_PROP_FRAME_WIDTH))
+    capture.release()
+    crop = (params["video"].get("crop") or {}).get("roi", "auto")
+    if crop != "auto":
+        height, width = crop[1] - crop[0], crop[3] - crop[2]
+    start, stop, step = frame_range(params)
+    count = len(range(start, count if stop is None else min(stop, count), step))
+    if "chunk_size" in params["video"].keys():
+        count = min(count, params["video"]["chunk_size"])
+
+    frame_bytes = 1
+    for stage in ["adjust", "normalize"]:
+        if stage in params["video"].keys():
+            frame_bytes = 1 if (params["video"][stage] or {}).get("dtype") == "uint8" else 8
+    if params["method"] == "object_detection":
+        mask_bytes = 0
+        if wants_output(params, "raw"):
+            mask_bytes = 1 / 8 if params.get("packed_masks", False) else 1
+    elif params["type"] == "background_subtraction":
+        mask_bytes = 1 if wants_output(params, "raw") or params["algorithm"].get("sharded", False) else 0
+    else:
+        mask_bytes = 4 if wants_output(params, "raw") or wants_output(params, "heatmap") else 0
+    if cores > 1:
+        frame_bytes *= 2
+    return int(count * height * width * (frame_bytes + mask_bytes)) + 2 ** 28
+
+
+def available_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# runs in a separate process for each video so a crash only fails that video
+def batch_worker(file, params, cores, output, config_yaml, extension, queue):
+    cv.setNumThreads(cores)
+    started = time.time()
+    try:
+        run_file(file, params, cores, output, config_yaml, extension)
+        queue.put(summary_row(file, "done", cores, time.time() - started))
+    except Exception:
+        queue.put(summary_row(file, "failed", cores, time.time() - started, traceback.format_exc()))
+
+
+# the files of a video are written while the next one is analysed and its frames are read while the current one is
+# analysed, so the batch takes about as long as the analysis alone
+def run_sequential(files, params, cores, output, config_yaml, extension, memory=None):
+    estimates = {file: estimate_memory(file, params, cores=cores) for file in files}
+    preload = preload_videos(params, files, estimates, available_memory() if memory is None else memory)
+    started = {}
+    writes = []
+    rows = []
+    with BackgroundWriter() as background, ThreadPoolExecutor(max_workers=1) as loader:
+        following = loader.submit(load_video, files[0], params) if preload else None
+        for i, file in enumerate(files):
+            started[file] = time.time()
+            current = following
+            following = loader.submit(load_video, files[i + 1], params) if preload and i + 1 < len(files) else None
+            try:
+                decoded = current.result() if current is not None else None
+                writes.append((file, run_file(file, params, cores, output, config_yaml, extension,
+                                              background=background, decoded=decoded)))
+            except Exception:
+                rows.append(summary_row(file, "failed", cores, time.time() - started[file], traceback.format_exc()))
+            current = decoded = None
+    for file, done in writes:
+        try:
+            rows.append(summary_row(file, "done", cores, done.result() - started[file]))
+        except Exception:
+            rows.append(summary_row(file, "failed", cores, time.time() - started[file], traceback.format_exc()))
+    rows.sort(key=lambda row: files.index(row["file"]))
+    return rows
+
+
+# the largest videos are started first, a video is started when there are free cores and its estimated memory fits
+# in the memory that is left. The free cores are divided between the videos that can still be started, so many
+# videos use one core each and the last videos of a batch get the cores of the finished ones
+def run_parallel(files, params, cores, output, config_yaml, extension, jobs, memory=None):
+    if memory is None:
+        memory = available_memory()
+    estimates = {file: estimate_memory(file, params, cores=max(cores // jobs, 1)) for file in files}
+    pending = sorted(files, key=lambda file: estimates[file], reverse=True)
+    running = {}
+    rows = []
+    queue = mp.Queue()
+    free_cores = cores
+    free_memory = memory
+    log("Analysing " + str(len(files)) + " files with up to " + str(jobs) + " at the same time")
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < jobs and free_cores > 0:
+            file = pending[0]
+            if free_memory is not None and estimates[file] > free_memory and len(running) > 0:
+                break
+            file_cores = max(free_cores // min(len(pending), jobs - len(running)), 1)
+            process = mp.Process(target=batch_worker, args=(file, params, file_cores, output, config_yaml,
+                                                            extension, queue))
+            process.start()
+            running[file] = (process, file_cores, estimates[file])
+            pending.pop(0)
+            free_cores -= file_cores
+            if free_memory is not None:
+                free_memory -= estimates[file]
+
+        finished = []
+        try:
+            finished.append(queue.get(timeout=1))
+        except Empty:
+            # a process that is killed, e.g. when it runs out of memory, never reports back
+            for file, (process, file_cores, estimate) in running.items():
+                if not process.is_alive() and queue.empty():
+                    finished.append(summary_row(file, "failed", file_cores, None,
+                                                "exit code " + str(process.exitcode)))
+        for row in finished:
+            process, file_cores, estimate = running.pop(row["file"])
+            process.join()
+            free_cores += file_cores
+            if free_memory is not None:
+                free_memory += estimate
+            rows.append(row)
+    return rows
+
+
+# several videos are analysed at the same time in separate processes, see run_parallel, or one after the other with
+# jobs=1. Failed files are kept in the summary and do not stop the batch
+def schedule(files, params, cores, output, config_yaml, extension, jobs=None, memory=None):
+    if jobs is None:
+        jobs = cores
+    jobs = max(min(jobs, cores, len(files)), 1)
+    if jobs == 1:
+        rows = run_sequential(files, params, cores, output, config_yaml, extension, memory=memory)
+    else:
+        rows = run_parallel(files, params, cores, output, config_yaml, extension, jobs, memory=memory)
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import pytest
+
+from cache import StageCache
+from analysis import cached_thresholds
+
+
+def test_key_depends_on_previous_stage_and_params(tmp_path):
+    cache = StageCache(str(tmp_path))
+    key = cache.key("video", "denoise", {"h": 3, "templateWindowSize": 7})
+    assert key == cache.key("video", "denoise", {"templateWindowSize": 7, "h": 3})
+    assert key != cache.key("video", "denoise", {"h": 4, "templateWindowSize": 7})
+    assert key != cache.key("other video", "denoise", {"h": 3, "templateWindowSize": 7})
+    assert key != cache.key("video", "adjust", {"h": 3, "templateWindowSize": 7})
+
+
+def test_hit_and_miss(tmp_path):
+    cache = StageCache(str(tmp_path))
+    frames = np.arange(2 * 3 * 4, dtype=np.uint8).reshape(2, 3, 4)
+    key = cache.key("video", "decode", {"grayscale": True})
+    cache.put(key, frames=frames)
+    assert key in cache
+    np.testing.assert_array_equal(cache.get(key)["frames"], frames)
+    # a changed parameter misses this stage and every stage after it
+    changed = cache.key("video", "decode", {"grayscale": False})
+    assert changed not in cache
+    assert cache.get(changed) is None
+    assert cache.get(cache.key(changed, "threshold", None)) is None
+
+
+@pytest.mark.parametrize("compression", [None, "lzf"])
+def test_get_returns_copy_on_write_arrays(tmp_path, compression):
+    cache = StageCache(str(tmp_path), compression=compression)
+    frames = np.zeros((3, 8, 8), dtype=np.uint8)
+    cache.put("frames", frames=frames)
+    cached = cache.get("frames")["frames"]
+    assert isinstance(cached, np.memmap) == (compression is None)
+    cached[0] = 255
+    np.testing.assert_array_equal(cache.get("frames")["frames"], frames)
+
+
+def test_eviction_past_max_size(tmp_path):
+    cache = StageCache(str(tmp_path), compression=None)
+    array = np.zeros(4096, dtype=np.uint8)
+    for i, key in enumerate(["first", "second"]):
+        cache.put(key, values=array)
+        # the least recently used entry is the one with the oldest modification time
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    # room for two entries, reading the first one makes the second one the least recently used
+    cache.max_size = cache.size()
+    cache.get("first")
+    cache.put("third", values=array)
+    assert "second" not in cache
+    assert "first" in cache and "third" in cache
+    assert cache.size() <= cache.max_size
+
+
+@pytest.mark.parametrize("compression", [None, "lzf"])
+def test_multi_otsu_thresholds_round_trip(tmp_path, compression):
+    cache = StageCache(str(tmp_path), compression=compression)
+    thresholds = [np.array([40.5, 120.25]), np.array([42.0, 118.0]), np.array([39.0, 121.5])]
+    cache.put("multi_otsu", threshold=thresholds)
+    cached = cached_thresholds(cache, "multi_otsu")
+    assert len(cached) == len(thresholds)
+    for threshold, expected in zip(cached, thresholds):
+        assert type(threshold) is np.ndarray
+        assert threshold.dtype == expected.dtype and threshold.shape == expected.shape
+        np.testing.assert_array_equal(threshold, expected)
+
+
+def test_scalar_thresholds_round_trip(tmp_path):
+    cache = StageCache(str(tmp_path), compression=None)
+    cache.put("otsu", threshold=[40, 42, 39])
+    cached = cached_thresholds(cache, "otsu")
+    assert [np.ndim(threshold) for threshold in cached] == [0, 0, 0]
+    assert [int(threshold) for threshold in cached] == [40, 42, 39]
+    assert cached_thresholds(cache, "missing") is None
+
+
+def test_file_hash_is_kept_until_the_file_changes(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    video = tmp_path / "video.avi"
+    video.write_bytes(b"first")
+    assert cache.file_hash(str(video)) == hashlib.sha256(b"first").hexdigest()
+    assert cache.hashes()[os.path.abspath(str(video))]["hash"] == hashlib.sha256(b"first").hexdigest()
+    video.write_bytes(b"second video")
+    assert cache.file_hash(str(video)) == hashlib.sha256(b"second video").hexdigest()
+
+
+def hash_file(directory, path):
+    return StageCache(directory).file_hash(path)
+
+
+# the videos of a batch are hashed in parallel processes, none of their hashes may be lost
+def test_parallel_file_hashes(tmp_path):
+    directory = str(tmp_path / "cache")
+    StageCache(directory)
+    paths = []
+    for i in range(8):
+        path = tmp_path / ("video" + str(i) + ".avi")
+        path.write_bytes(os.urandom(2 ** 16))
+        paths.append(str(path))
+    with mp.Pool(4) as pool:
+        hashes = pool.starmap(hash_file, [(directory, path) for path in paths])
+    with open(os.path.join(directory, "hashes.json")) as f:
+        known = json.load(f)
+    assert [known[os.path.abspath(path)]["hash"] for path in paths] == hashes
+    assert not any(name.endswith(".tmp") for name in os.listdir(directory))
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from object import Watershed
+
+PROPERTIES = ["label", "area", "centroid", "bbox", "eccentricity"]
+
+
+# bright blobs on a noisy background, with tile=64 the blob at (128, 64) lies across two seams and the long bar with
+# the blob at (64, 64) on it crosses a seam along its whole length
+def seam_frames(n=3, height=160, width=200, seed=0):
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:height, :width]
+    frames = []
+    for i in range(n):
+        frame = np.full((height, width), 50.0)
+        for cy, cx, r in [(64 + i, 64, 12), (128, 64 + 2 * i, 10), (30, 128, 9), (100 + i, 150, 15)]:
+            frame[(yy - cy) ** 2 + (xx - cx) ** 2 < r ** 2] = 180
+        frame[60:68, 20:190] = 170
+        frame += rng.normal(0, 5, (height, width))
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return np.stack(frames)
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_tiled_masks_equal_whole_frame(cores):
+    frames = seam_frames()
+    seg = Watershed()
+    thresholds = seg.threshold(frames=frames, method="otsu", inplace=False)
+    whole = seg.segmentation(frames=frames, threshold=thresholds, inplace=False)
+    tiled = seg.segmentation(frames=frames, threshold=thresholds, inplace=False, cores=cores, tile=64, overlap=32)
+    for i in range(len(frames)):
+        np.testing.assert_array_equal(np.asarray(tiled[i]), np.asarray(whole[i]))
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_tiled_properties_equal_whole_frame(cores):
+    frames = seam_frames()
+    seg = Watershed()
+    thresholds = seg.threshold(frames=frames, method="otsu", inplace=False)
+    masks = seg.segmentation(frames=frames, threshold=thresholds, inplace=False)
+    whole = seg.properties(masks=masks, frames=frames, properties=PROPERTIES, min_size=20)
+    tiled = seg.properties(masks=masks, frames=frames, cores=cores, tile=64, properties=PROPERTIES, min_size=20)
+    # the background, the bar and three blobs, the parts of the regions on both sides of the seams have to be merged
+    assert (whole.groupby("frame").size() == 5).all()
+    pd.testing.assert_frame_equal(tiled.reset_index(drop=True), whole.reset_index(drop=True), check_dtype=False)
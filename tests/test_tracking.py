@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tracking import Tracker
+
+
+def regions(rows):
+    return pd.DataFrame(rows, columns=["frame", "label", "centroid-0", "centroid-1", "area"])
+
+
+# a small and a large object move diagonally and cross at frame 5, at the crossing the small one is closer to where the
+# large one was so matching each region to its nearest track would swap them
+def crossing(frames=range(11)):
+    rows = []
+    for t in frames:
+        rows.append((t, 1, 10.0 * t, 10.0 * t, 100))
+        rows.append((t, 2, 10.0 * t + 2, 100 - 10.0 * t, 400))
+    return regions(rows)
+
+
+def test_crossing_objects_keep_their_tracks():
+    tracked = Tracker(max_distance=30).add(crossing())
+    assert tracked.groupby("area")["track"].nunique().tolist() == [1, 1]
+    assert tracked.groupby("track")["area"].nunique().tolist() == [1, 1]
+
+
+def test_track_spans_several_calls():
+    tracker = Tracker(max_distance=30)
+    first = tracker.add(crossing(range(5)))
+    second = tracker.add(crossing(range(5, 11)))
+    assert len(tracker) == 2
+    assert (first.groupby("area")["track"].first() == second.groupby("area")["track"].first()).all()
+    summary = tracker.summary()
+    assert summary["first_frame"].tolist() == [0, 0]
+    assert summary["last_frame"].tolist() == [10, 10]
+    assert summary["frames"].tolist() == [11, 11]
+    assert summary["mean_area"].tolist() == [100, 400]
+    with pytest.raises(ValueError):
+        tracker.add(crossing(range(3)))
+
+
+# the object is not found in frames 3 and 4
+@pytest.mark.parametrize("memory,tracks", [(2, [0, 0, 0, 0, 0, 0]), (1, [0, 0, 0, 1, 1, 1])])
+def test_object_reappears_within_memory(memory, tracks):
+    frames = [0, 1, 2, 5, 6, 7]
+    found = regions([(t, 1, 50.0 + t, 50.0, 200) for t in frames])
+    tracker = Tracker(max_distance=30, memory=memory)
+    tracked = tracker.add(found)
+    assert tracked["track"].tolist() == tracks
+    assert tracker.summary()["frames"].tolist() == np.bincount(tracks).tolist()
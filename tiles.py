@@ -0,0 +1,142 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+from utils import apply_watershed
+from parallel import attach
+
+
+# the tiles of a frame as (core, outer) pairs of slices, the cores cover the frame without overlapping and the outer
+# slices add overlap pixels on every side (less at the edges of the frame). tile is an int or (height, width)
+def tile_grid(shape, tile, overlap=0):
+    if isinstance(tile, int):
+        tile = (tile, tile)
+    if tile[0] < 1 or tile[1] < 1 or overlap < 0:
+        raise ValueError("tile needs to be positive and overlap can not be negative")
+    height, width = shape
+    grid = []
+    for row in range(0, height, tile[0]):
+        for col in range(0, width, tile[1]):
+            core = (slice(row, min(row + tile[0], height)), slice(col, min(col + tile[1], width)))
+            outer = (slice(max(row - overlap, 0), min(row + tile[0] + overlap, height)),
+                     slice(max(col - overlap, 0), min(col + tile[1] + overlap, width)))
+            grid.append((core, outer))
+    return grid
+
+
+# a tile can not have more labels than pixels so the labels of tile i start after the pixels of the tiles before it,
+# this way the tiles are labelled in parallel without knowing how many labels the others have
+def tile_offsets(grid):
+    areas = [(core[0].stop - core[0].start) * (core[1].stop - core[1].start) for core, outer in grid]
+    return np.concatenate([[0], np.cumsum(areas)[:-1]]).astype(np.int64)
+
+
+def label_dtype(shape):
+    return np.int32 if shape[0] * shape[1] < 2 ** 31 else np.int64
+
+
+# these run in the worker processes, the frames, masks and labels are read from shared memory
+def segment_tile(index, core, outer, threshold, frames, masks, **kwargs):
+    mask = apply_watershed(np.asarray(attach(frames)[index][outer]), threshold, **kwargs)
+    inner = (slice(core[0].start - outer[0].start, core[0].stop - outer[0].start),
+             slice(core[1].start - outer[1].start, core[1].stop - outer[1].start))
+    attach(masks, mode="r+")[index][core] = mask[inner]
+
+
+# labels one tile of the mask and writes the labels plus offset to the label image of the frame. regions labels the
+# connected pixels with the same value like label(mask), background the pixels of the first class with 4
+# connectivity like binary_fill_holes and filled the other classes and the holes that are already marked with 1 in
+# the label image. Returns the number of labels and for every label the index of its first pixel in the frame, its
+# area, intensity sum and whether it touches the edge of the frame
+def label_tile(core, offset, index, masks, labels, frames=None, mode="regions"):
+    mask = np.asarray(attach(masks)[index][core])
+    output = attach(labels, mode="r+")
+    if mode == "regions":
+        local, count = label(mask, connectivity=2, return_num=True)
+    elif mode == "background":
+        local, count = label(mask == 1, connectivity=1, return_num=True)
+    elif mode == "filled":
+        local, count = label((mask != 1) | (output[core] == 1), connectivity=2, return_num=True)
+    else:
+        raise ValueError("mode can be 'regions', 'background' or 'filled'")
+    output[core] = np.where(local > 0, local + offset, 0)
+
+    flat = local.ravel()
+    ids, first = np.unique(flat, return_index=True)
+    first = first[ids > 0]
+    rows, cols = np.divmod(first, local.shape[1])
+    first = (rows + core[0].start) * output.shape[1] + cols + core[1].start
+    areas = np.bincount(flat, minlength=count + 1)[1:]
+    sums = None
+    if frames is not None:
+        image = np.asarray(attach(frames)[index][core])
+        sums = np.bincount(flat, weights=image.ravel(), minlength=count + 1)[1:]
+    edge = np.zeros(count + 1, dtype=bool)
+    if core[0].start == 0:
+        edge[local[0]] = True
+    if core[0].stop == output.shape[0]:
+        edge[local[-1]] = True
+    if core[1].start == 0:
+        edge[local[:, 0]] = True
+    if core[1].stop == output.shape[1]:
+        edge[local[:, -1]] = True
+    return count, first, areas, sums, edge[1:]
+
+
+# lookup has a value for every label of the tile, 0 stays 0
+def relabel_tile(core, offset, lookup, labels):
+    output = attach(labels, mode="r+")
+    local = np.asarray(output[core])
+    found = local > 0
+    local[found] = lookup[local[found] - offset - 1]
+    output[core] = local
+
+
+# the pairs of labels that touch across the seams between the tiles, with values only pixels with the same value are
+# connected
+def seam_pairs(labels, grid, values=None, connectivity=2):
+    rows = sorted(set(core[0].start for core, outer in grid) - {0})
+    cols = sorted(set(core[1].start for core, outer in grid) - {0})
+    lines = [(labels[row - 1], labels[row], None if values is None else values[row - 1],
+              None if values is None else values[row]) for row in rows]
+    lines += [(labels[:, col - 1], labels[:, col], None if values is None else values[:, col - 1],
+               None if values is None else values[:, col]) for col in cols]
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for first, second, first_values, second_values in lines:
+        first, second = np.asarray(first), np.asarray(second)
+        for shift in shifts:
+            a = first[max(-shift, 0):len(first) - max(shift, 0)]
+            b = second[max(shift, 0):len(second) - max(-shift, 0)]
+            touching = (a > 0) & (b > 0)
+            if values is not None:
+                va = np.asarray(first_values)[max(-shift, 0):len(first) - max(shift, 0)]
+                vb = np.asarray(second_values)[max(shift, 0):len(second) - max(-shift, 0)]
+                touching &= va == vb
+            pairs.append(np.stack([a[touching], b[touching]], axis=1).astype(np.int64))
+    return np.concatenate(pairs)
+
+
+# the labels of all tiles are numbered from 0 in the order of the tiles, returns the number of regions and the region
+# of every label
+def merge_labels(pairs, offsets, counts):
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    total = int(np.sum(counts))
+
+    def compact(ids):
+        tile = np.searchsorted(offsets, ids, side="left") - 1
+        return starts[tile] + ids - offsets[tile] - 1
+
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (compact(pairs[:, 0]), compact(pairs[:, 1]))),
+                       shape=(total, total))
+    return connected_components(graph, directed=False)
+
+
+# label() numbers the regions in the order of their first pixel, the merged regions are numbered the same way so the
+# labels match the ones of the whole frame
+def region_order(regions, count, first):
+    first_pixel = np.full(count, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_pixel, regions, first)
+    order = np.empty(count, dtype=np.int64)
+    order[np.argsort(first_pixel, kind="stable")] = np.arange(1, count + 1)
+    return order
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
+
+CENTROID = ["centroid-0", "centroid-1"]
+BBOX = ["bbox-0", "bbox-1", "bbox-2", "bbox-3"]
+VALUES = ["area", "intensities", "eccentricity"]
+
+
+# intersection over union of the bounding boxes in the rows of a and b
+def bbox_iou(a, b):
+    rows = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    cols = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    intersection = rows * cols
+    union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - intersection
+    return np.divide(intersection, union, out=np.zeros(len(union)), where=union > 0)
+
+
+# the cheapest one to one matching of the candidate pairs (rows[i], cols[i]) with costs[i]. The candidates are split
+# into groups that do not share a row or a column, a group with a single pair is matched directly and the others are
+# solved with linear_sum_assignment, so the time depends on the size of the groups and not on the number of regions
+def assign(rows, cols, costs, n_rows, n_cols):
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols + n_rows)),
+                       shape=(n_rows + n_cols, n_rows + n_cols))
+    count, component = connected_components(graph, directed=False)
+    group = component[rows]
+    single = np.bincount(group, minlength=count)[group] == 1
+    matched_rows = [rows[single]]
+    matched_cols = [cols[single]]
+
+    order = np.argsort(group[~single], kind="stable")
+    group, rows, cols, costs = group[~single][order], rows[~single][order], cols[~single][order], costs[~single][order]
+    # pairs that are not candidates cost more than any matching of the candidates
+    missing = costs.sum() + 1 if len(costs) > 0 else 1
+    bounds = np.flatnonzero(np.diff(group)) + 1
+    for group_rows, group_cols, group_costs in zip(np.split(rows, bounds), np.split(cols, bounds),
+                                                   np.split(costs, bounds)):
+        if len(group_rows) == 0:
+            continue
+        unique_rows, row_index = np.unique(group_rows, return_inverse=True)
+        unique_cols, col_index = np.unique(group_cols, return_inverse=True)
+        cost = np.full((len(unique_rows), len(unique_cols)), missing)
+        cost[row_index, col_index] = group_costs
+        chosen_rows, chosen_cols = linear_sum_assignment(cost)
+        found = cost[chosen_rows, chosen_cols] < missing
+        matched_rows.append(unique_rows[chosen_rows[found]])
+        matched_cols.append(unique_cols[chosen_cols[found]])
+    return np.concatenate(matched_rows), np.concatenate(matched_cols)
+
+
+# links the regions of consecutive frames into tracks. The regions of a frame are matched to the tracks that were
+# seen in the last memory + 1 frames (step is the difference of the frame numbers of consecutive frames) and are
+# closer than max_distance pixels, the candidates are found with a kd-tree so only nearby pairs are compared. The cost
+# of a pair is the distance divided by max_distance, plus 1 - the overlap of the bounding boxes if the bbox is
+# measured and area_weight times the log of the ratio of the areas. Regions that are not matched start a new track.
+# The tracks are kept between calls so the frames can be added in chunks, a running sum of the values of every track
+# is kept for summary
+class Tracker:
+    def __init__(self, max_distance=50, memory=0, area_weight=1.0, step=1, values=VALUES):
+        if max_distance <= 0:
+            raise ValueError("max_distance needs to be positive")
+        if memory < 0:
+            raise ValueError("memory can not be negative")
+        self.max_distance = max_distance
+        self.memory = memory
+        self.area_weight = area_weight
+        self.step = step
+        self.values = list(values)
+        self.positions = np.empty((0, 2))
+        self.boxes = np.empty((0, 4))
+        self.areas = np.empty(0)
+        self.first = np.empty(0, dtype=np.int64)
+        self.last = np.empty(0, dtype=np.int64)
+        self.length = np.empty(0, dtype=np.int64)
+        self.sums = np.empty((0, len(self.values)))
+        self.frame = None
+
+    def __len__(self):
+        return len(self.last)
+
+    # results is a table of regions with frame, centroid-0 and centroid-1 columns, a copy with a track column is
+    # returned
+    def add(self, results):
+        if any(column not in results.columns for column in ["frame"] + CENTROID):
+            raise ValueError("tracking needs the frame and the centroid of the regions, add centroid to the properties")
+        results = results.copy()
+        tracks = np.empty(len(results), dtype=np.int64)
+        frames = results["frame"].to_numpy()
+        positions = results[CENTROID].to_numpy(dtype=float)
+        boxes = results[BBOX].to_numpy(dtype=float) if all(column in results.columns for column in BBOX) else None
+        areas = results["area"].to_numpy(dtype=float) if "area" in results.columns else None
+
+        order = np.argsort(frames, kind="stable")
+        bounds = np.flatnonzero(np.diff(frames[order])) + 1
+        for index in np.split(order, bounds):
+            if len(index) == 0:
+                continue
+            tracks[index] = self.link(frames[index[0]], positions[index],
+                                      None if boxes is None else boxes[index], None if areas is None else areas[index])
+
+        for i, column in enumerate(self.values):
+            if column in results.columns:
+                np.add.at(self.sums[:, i], tracks, results[column].to_numpy(dtype=float))
+        results.insert(int("label" in results.columns) + 1, "track", tracks)
+        return results
+
+    # the tracks of the regions of a single frame
+    def link(self, frame, positions, boxes=None, areas=None):
+        if self.frame is not None and frame <= self.frame:
+            raise ValueError("frame " + str(frame) + " was added after frame " + str(self.frame) +
+                             ", the frames have to be added in order")
+        self.frame = frame
+        ids = np.full(len(positions), -1, dtype=np.int64)
+        active = np.flatnonzero(self.last >= frame - (self.memory + 1) * self.step)
+        if len(active) > 0:
+            pairs = cKDTree(positions).sparse_distance_matrix(cKDTree(self.positions[active]), self.max_distance,
+                                                              output_type="ndarray")
+            regions, candidates = pairs["i"].astype(np.int64), pairs["j"].astype(np.int64)
+            costs = pairs["v"] / self.max_distance
+            if boxes is not None:
+                costs = costs + 1 - bbox_iou(boxes[regions], self.boxes[active[candidates]])
+            if areas is not None and self.area_weight:
+                costs = costs + self.area_weight * np.abs(np.log(np.maximum(areas[regions], 1) /
+                                                                 np.maximum(self.areas[active[candidates]], 1)))
+            matched_regions, matched_tracks = assign(regions, candidates, costs, len(positions), len(active))
+            ids[matched_regions] = active[matched_tracks]
+
+        new = np.flatnonzero(ids < 0)
+        if len(new) > 0:
+            ids[new] = np.arange(len(self), len(self) + len(new))
+            self.grow(len(new), frame)
+        self.positions[ids] = positions
+        if boxes is not None:
+            self.boxes[ids] = boxes
+        if areas is not None:
+            self.areas[ids] = areas
+        self.last[ids] = frame
+        self.length[ids] += 1
+        return ids
+
+    def grow(self, count, frame):
+        self.positions = np.concatenate([self.positions, np.zeros((count, 2))])
+        self.boxes = np.concatenate([self.boxes, np.zeros((count, 4))])
+        self.areas = np.concatenate([self.areas, np.zeros(count)])
+        self.first = np.concatenate([self.first, np.full(count, frame, dtype=np.int64)])
+        self.last = np.concatenate([self.last, np.full(count, frame, dtype=np.int64)])
+        self.length = np.concatenate([self.length, np.zeros(count, dtype=np.int64)])
+        self.sums = np.concatenate([self.sums, np.zeros((count, len(self.values)))])
+
+    # one row per track with its first and last frame, the number of frames it was found in and the mean of the values
+    def summary(self):
+        summary = pd.DataFrame({"track": np.arange(len(self)), "first_frame": self.first, "last_frame": self.last,
+                                "frames": self.length})
+        for i, column in enumerate(self.values):
+            summary["mean_" + column] = self.sums[:, i] / np.maximum(self.length, 1)
+        return summary
+
+
+def link(results, max_distance=50, memory=0, area_weight=1.0, step=1):
+    return Tracker(max_distance=max_distance, memory=memory, area_weight=area_weight, step=step).add(results)
+
+
+# the values of every track as time series, one row per frame and a column per value and track, frames in which a
+# track was not found are nan. Tracks shorter than min_length frames are left out
+def track_series(tracked, values=VALUES, min_length=1):
+    values = [column for column in values if column in tracked.columns]
+    lengths = tracked["track"].value_counts()
+    tracked = tracked[tracked["track"].isin(lengths.index[lengths >= min_length])]
+    return tracked.pivot_table(index="frame", columns="track", values=values, aggfunc="first")
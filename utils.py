@@ -1,6 +1,12 @@
 import skimage.exposure as exp
+import skimage.filters as filt
+import cv2 as cv
+from skimage.filters import rank
+from skimage.morphology import disk
 from scipy import ndimage as ndi
-from functools import partial
+from functools import partial, lru_cache
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from skimage.segmentation import watershed
 import numpy as np
 from skimage.measure import regionprops_table, label
@@ -22,13 +28,408 @@ def adjust(frame, method, **kwargs):
         raise ValueError("method can be equalize, gamma, log, sigmoid or adaptive")
     return adjusted
 
+# the disk footprint is the same for every frame so it is only built once
+@lru_cache(maxsize=None)
+def footprint(dsk):
+    return disk(dsk)
+
+# if out is given the grayscale frame is written into it, this is used to fill the preallocated frame store. crop is
+# a box [y0, y1, x0, x1], only this part of the frame is converted and kept
+def preprocess_frame(frame, invert=False, denoise=False, dsk=2, out=None, crop=None):
+    if crop is not None:
+        frame = frame[crop[0]:crop[1], crop[2]:crop[3]]
+    if denoise:
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        if invert:
+            cv.bitwise_not(gray, dst=gray)
+        if out is None:
+            return rank.median(gray, footprint(dsk))
+        rank.median(gray, footprint(dsk), out=out)
+        return out
+
+    if out is None:
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+    else:
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=out)
+    if invert:
+        cv.bitwise_not(gray, dst=gray)
+    return gray
+
+# minimum and maximum over a list of frames or a whole frame array without stacking them first
+def min_max(frames):
+    if isinstance(frames, np.ndarray) or hasattr(frames, "array"):
+        frames = np.asarray(frames)
+        return frames.min(), frames.max()
+    return min(frame.min() for frame in frames), max(frame.max() for frame in frames)
+
+# gamma, log and sigmoid only depend on the pixel value so for 8 bit frames they are calculated once for all
+# 256 values and applied to the whole frame stack as a lookup table
+LUT_METHODS = {"gamma": exp.adjust_gamma, "log": exp.adjust_log, "sigmoid": exp.adjust_sigmoid}
+
+
+# scaled means float values are between 0 and 1 like skimage returns them, otherwise they are already 0-255
+def convert_dtype(values, dtype=None, scaled=True):
+    if dtype is None:
+        return values
+    dtype = np.dtype(dtype)
+    if values.dtype == dtype:
+        return values
+    elif dtype == np.uint8:
+        if np.issubdtype(values.dtype, np.floating):
+            if scaled:
+                values = values * 255
+            return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+        return values.astype(np.uint8)
+    elif np.issubdtype(dtype, np.floating):
+        if values.dtype == np.uint8 and scaled:
+            return (values / 255).astype(dtype)
+        return values.astype(dtype)
+    else:
+        raise ValueError("dtype can only be uint8 or a float type")
+
+
+def adjust_lut(method, dtype=None, **kwargs):
+    lut = LUT_METHODS[method](np.arange(256, dtype=np.uint8), **kwargs)
+    return convert_dtype(lut, dtype)
+
+
+# same as skimage's equalize_hist for 8 bit images but from a single bincount of the frame
+def equalize_lut(frame, mask=None, dtype=None):
+    if mask is not None:
+        pixels = frame[np.asarray(mask, dtype=bool)]
+    else:
+        pixels = frame.ravel()
+    hist = np.bincount(pixels, minlength=256)
+    present = np.flatnonzero(hist)
+    low, high = present[0], present[-1]
+    cdf = hist[low:high + 1].cumsum()
+    cdf = cdf / float(cdf[-1])
+    lut = np.interp(np.arange(256), np.arange(low, high + 1), cdf)
+    return convert_dtype(lut, dtype)
+
+
+def adaptive_frame(frame, dtype=None, **kwargs):
+    return convert_dtype(exp.equalize_adapthist(frame, **kwargs), dtype)
+
+
+# adjusts a whole stack of frames at once and returns a (frames, height, width) array, dtype can be used to
+# keep the output as uint8 instead of float64 for equalize and adaptive
+def adjust_frames(frames, method, dtype=None, cores=1, **kwargs):
+    if method not in ["equalize", "gamma", "log", "sigmoid", "adaptive"]:
+        raise ValueError("method can be equalize, gamma, log, sigmoid or adaptive")
+    frames = np.asarray(frames)
+
+    if frames.dtype != np.uint8:
+        adjusted = [convert_dtype(np.asarray(adjust(frame, method, **kwargs)), dtype) for frame in frames]
+        return np.stack(adjusted)
+
+    if method in LUT_METHODS:
+        return np.take(adjust_lut(method, dtype=dtype, **kwargs), frames)
+    elif method == "equalize":
+        kwargs.pop("nbins", None)  # ignored for 8 bit images
+        out = None
+        for i in range(len(frames)):
+            lut = equalize_lut(frames[i], dtype=dtype, **kwargs)
+            if out is None:
+                out = np.empty(frames.shape, dtype=lut.dtype)
+            np.take(lut, frames[i], out=out[i])
+        return out
+    else:
+        adapt = curry(adaptive_frame, dtype=dtype, **kwargs)
+        if cores > 1:
+            with Pool(cores) as p:
+                adjusted = p.map(adapt, frames, chunksize=max(len(frames) // (cores * 4), 1))
+        else:
+            adjusted = [adapt(frame) for frame in frames]
+        out = np.empty(frames.shape, dtype=adjusted[0].dtype)
+        for i in range(len(adjusted)):
+            out[i] = adjusted[i]
+        return out
+
+
+# histogram matching for 8 bit frames, the reference quantiles are calculated once and every frame is mapped
+# through a 256 value lookup table from its own histogram. This gives the same result as skimage's match_histograms
+def reference_cdf(reference):
+    counts = np.bincount(reference.ravel(), minlength=256)
+    values = np.flatnonzero(counts)
+    quantiles = np.cumsum(counts[values]) / reference.size
+    return values, quantiles
+
+
+def match_lut(frame, cdf, dtype=None):
+    values, quantiles = cdf
+    frame_quantiles = np.cumsum(np.bincount(frame.ravel(), minlength=256)) / frame.size
+    return convert_dtype(np.interp(frame_quantiles, quantiles, values), dtype, scaled=False)
+
+
+def match_frame(frame, cdf=None, reference=None, dtype=None):
+    if cdf is None:
+        return convert_dtype(exp.match_histograms(frame, reference), dtype)
+    return np.take(match_lut(frame, cdf, dtype=dtype), frame)
+
+
+def normalize_frames(frames, reference, dtype=None, cores=1):
+    frames = np.asarray(frames)
+    reference = np.asarray(reference)
+    if frames.dtype == np.uint8 and reference.dtype == np.uint8:
+        match = curry(match_frame, cdf=reference_cdf(reference), dtype=dtype)
+    else:
+        match = curry(match_frame, reference=reference, dtype=dtype)
+
+    if cores > 1:
+        with Pool(cores) as p:
+            matched = p.map(match, frames, chunksize=max(len(frames) // (cores * 4), 1))
+    else:
+        matched = [match(frame) for frame in frames]
+
+    out = np.empty(frames.shape, dtype=matched[0].dtype)
+    for i in range(len(matched)):
+        out[i] = matched[i]
+    return out
+
+
+# splits range(start, stop, step) into at most parts contiguous (start, stop, step) ranges
+def split_range(start, stop, step, parts):
+    indices = range(start, stop, step)
+    bounds = np.linspace(0, len(indices), min(parts, max(len(indices), 1)) + 1).astype(int)
+    ranges = []
+    for i in range(len(bounds) - 1):
+        if bounds[i] == bounds[i + 1]:
+            continue
+        ranges.append((indices[bounds[i]], indices[bounds[i + 1] - 1] + 1, step))
+    return ranges
+
+
+# median denoising backends, opencv uses a square (2*dsk+1) kernel, rank uses a disk of radius dsk like get_frames
+# and temporal takes the median of each pixel over window neighbouring frames
+DENOISE_METHODS = ["opencv", "rank", "temporal"]
+
+
+def median_frame(frame, method="rank", dsk=2):
+    if method == "opencv":
+        return cv.medianBlur(frame, 2 * dsk + 1)
+    elif method == "rank":
+        return rank.median(frame, footprint(dsk))
+    else:
+        raise ValueError("method can be opencv, rank or temporal")
+
+
+def temporal_median(frames, start, stop, window=3):
+    half = window // 2
+    window = min(window, len(frames))
+    out = np.empty((stop - start,) + frames.shape[1:], dtype=frames.dtype)
+    for i in range(start, stop):
+        # the window is shifted at the ends of the video so it always has the same number of frames
+        first = min(max(i - half, 0), len(frames) - window)
+        out[i - start] = np.median(frames[first:first + window], axis=0)
+    return out
+
+
+def denoise_frames(frames, method="rank", dsk=2, window=3, cores=1, pool="process"):
+    if method not in DENOISE_METHODS:
+        raise ValueError("method can be opencv, rank or temporal")
+    if pool not in ["process", "thread"]:
+        raise ValueError("pool can be process or thread")
+    frames = np.asarray(frames)
+    out = np.empty_like(frames)
+
+    if method == "temporal":
+        ranges = [(part[0], part[1]) for part in split_range(0, len(frames), 1, max(cores, 1))]
+        func = partial(temporal_median, frames, window=window)
+        if cores > 1:
+            # threads share the frames, numpy releases the GIL while sorting
+            with ThreadPool(cores) as p:
+                parts = p.starmap(func, ranges)
+        else:
+            parts = [func(*part) for part in ranges]
+        for (start, stop), part in zip(ranges, parts):
+            out[start:stop] = part
+        return out
+
+    func = curry(median_frame, method=method, dsk=dsk)
+    if cores > 1:
+        if pool == "thread":
+            p = ThreadPool(cores)
+        else:
+            p = Pool(cores)
+        with p:
+            denoised = p.map(func, frames, chunksize=max(len(frames) // (cores * 4), 1))
+        for i in range(len(denoised)):
+            out[i] = denoised[i]
+    else:
+        for i in range(len(frames)):
+            out[i] = func(frames[i])
+    return out
+
+
+# 256 bin histograms of every frame, opencv's calcHist is much faster than bincount but counts in float32 so it is
+# only used when a bin can not have more than 2**24 pixels
+def batch_histograms(frames):
+    frames = np.asarray(frames)
+    if frames.dtype != np.uint8:
+        raise ValueError("histograms can only be calculated for 8 bit frames")
+    hists = np.empty((len(frames), 256), dtype=np.int64)
+    exact = frames[0].size <= 2 ** 24 if len(frames) > 0 else True
+    for i in range(len(frames)):
+        if exact:
+            hists[i] = cv.calcHist([frames[i]], [0], None, [256], [0, 256]).ravel()
+        else:
+            hists[i] = np.bincount(frames[i].ravel(), minlength=256)
+    return hists
+
+
+# the thresholds below work on a (frames, 256) histogram array and give the same values as the skimage
+# functions do for 8 bit frames. skimage only uses the bins between the smallest and the largest value in the
+# frame, bins outside of that range are ignored here
+def histogram_range(hists):
+    present = hists > 0
+    low = np.argmax(present, axis=1)
+    high = 255 - np.argmax(present[:, ::-1], axis=1)
+    centers = np.arange(256)
+    # positions where a split between two bins is inside the range of the frame
+    valid = (centers[None, :-1] >= low[:, None]) & (centers[None, :-1] < high[:, None])
+    return low, high, valid
+
+
+def otsu_histograms(hists):
+    low, high, valid = histogram_range(hists)
+    centers = np.arange(256)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight1 = np.cumsum(hists, axis=1)
+        weight2 = np.cumsum(hists[:, ::-1], axis=1)[:, ::-1]
+        mean1 = np.cumsum(hists * centers, axis=1) / weight1
+        mean2 = (np.cumsum((hists * centers)[:, ::-1], axis=1) / weight2[:, ::-1])[:, ::-1]
+        variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    variance12[~valid] = -np.inf
+    return np.where(low == high, low, np.argmax(variance12, axis=1))
+
+
+def yen_histograms(hists):
+    low, high, valid = histogram_range(hists)
+    pmf = hists.astype(np.float32) / hists.sum(axis=1, keepdims=True)
+    p1 = np.cumsum(pmf, axis=1)
+    p1_sq = np.cumsum(pmf ** 2, axis=1)
+    p2_sq = np.cumsum((pmf ** 2)[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crit = np.log(((p1_sq[:, :-1] * p2_sq[:, 1:]) ** -1) * (p1[:, :-1] * (1.0 - p1[:, :-1])) ** 2)
+    crit[~valid] = -np.inf
+    return np.where(low == high, low, np.argmax(crit, axis=1))
+
+
+def isodata_histograms(hists):
+    low, high, valid = histogram_range(hists)
+    centers = np.arange(256)
+    counts = hists.astype(np.float32)
+    csuml = np.cumsum(counts, axis=1)
+    csumh = csuml[:, -1:] - csuml
+    csum_intensity = np.cumsum(counts * centers, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower = csum_intensity[:, :-1] / csuml[:, :-1]
+        higher = (csum_intensity[:, -1:] - csum_intensity[:, :-1]) / csumh[:, :-1]
+    distances = (lower + higher) / 2.0 - centers[:-1]
+    found = (distances >= 0) & (distances < 1) & valid
+    return np.where(low == high, low, np.argmax(found, axis=1))
+
+
+# Li's iterative minimum cross entropy on the histogram of a single frame, initial_guess is used to start the
+# iterations from the threshold of the previous frame. A warm start is already close to the result so the default
+# tolerance of half a grey level would stop after the first step and the error would add up from frame to frame,
+# warm starts iterate to 0.01 grey levels instead
+def li_histogram(hist, tolerance=None, initial_guess=None):
+    present = np.flatnonzero(hist)
+    low, high = present[0], present[-1]
+    if low == high:
+        return float(low)
+    counts = hist[low:high + 1].astype(np.float32)
+    centers = np.arange(high - low + 1)
+    if initial_guess is not None and 0 < initial_guess - low < high - low:
+        tolerance = tolerance or 0.01
+        t_next = float(initial_guess - low)
+    else:
+        tolerance = tolerance or 0.5
+        t_next = np.average(centers, weights=counts)
+    t_curr = -2 * tolerance
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = centers > t_curr
+        background = ~foreground
+        mean_fore = np.average(centers[foreground], weights=counts[foreground])
+        mean_back = np.average(centers[background], weights=counts[background])
+        if mean_back == 0:
+            break
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+    return t_next + low
+
+
+def multiotsu_histogram(hist, frame, classes=3, **kwargs):
+    present = np.flatnonzero(hist)
+    try:
+        return filt.threshold_multiotsu(classes=classes, hist=(hist[present[0]:present[-1] + 1],
+                                                               np.arange(present[0], present[-1] + 1)))
+    except TypeError:  # older versions of skimage do not take a histogram
+        return filt.threshold_multiotsu(frame, classes=classes, **kwargs)
+
+
+# thresholds for consecutive frames from their histograms. With drift the threshold is only recalculated when the
+# histogram has changed by more than drift (half the sum of the absolute differences of the normalized histograms,
+# between 0 and 1) since the last calculated frame. state is the (histogram, threshold) of the last frame of the
+# previous call so chunks of a streamed video continue where the previous chunk stopped
+def temporal_thresholds(frames, method, drift=None, state=None, **kwargs):
+    frames = np.asarray(frames)
+    hists = batch_histograms(frames)
+    density = hists / hists.sum(axis=1, keepdims=True)
+
+    if state is not None:
+        reference, previous = state
+    else:
+        reference, previous = None, kwargs.pop("initial_guess", None)
+    kwargs.pop("initial_guess", None)
+
+    recalculate = np.ones(len(frames), dtype=bool)
+    if drift is not None:
+        for i in range(len(frames)):
+            if reference is not None and 0.5 * np.abs(density[i] - reference).sum() <= drift:
+                recalculate[i] = False
+            else:
+                reference = density[i]
+    elif len(frames) > 0:
+        reference = density[-1]
+
+    thresholds = [None] * len(frames)
+    indices = np.flatnonzero(recalculate)
+    if method in ["otsu", "yen", "isodata"]:
+        funcs = {"otsu": otsu_histograms, "yen": yen_histograms, "isodata": isodata_histograms}
+        calculated = funcs[method](hists[indices]) if len(indices) > 0 else []
+        for i, threshold in zip(indices, calculated):
+            thresholds[i] = threshold
+    elif method == "li":
+        for i in indices:
+            previous = li_histogram(hists[i], tolerance=kwargs.get("tolerance"), initial_guess=previous)
+            thresholds[i] = previous
+    elif method == "multi_otsu":
+        kwargs.pop("nbins", None)
+        for i in indices:
+            thresholds[i] = multiotsu_histogram(hists[i], frames[i], **kwargs)
+    else:
+        raise ValueError("method can be 'isodata', 'li', "
+                         "'otsu', 'multi_otsu' or 'yen")
+
+    # frames that were not recalculated use the threshold of the frame before them
+    for i in range(len(frames)):
+        if thresholds[i] is None:
+            thresholds[i] = previous if i == 0 else thresholds[i - 1]
+        previous = thresholds[i]
+    return thresholds, (reference, previous)
+
+
 def curry(orig_func, **kwargs):
     newfunc=partial(orig_func, **kwargs)
     return newfunc
 
+# there are only two classes so the markers and the mask are uint8 whatever the type of the frame is
 def apply_watershed(frame, threshold, **kwargs):
-    markers=np.zeros_like(frame)
-    if type(threshold)==np.ndarray:
+    markers=np.zeros(frame.shape, dtype=np.uint8)
+    if np.ndim(threshold) > 0:
         markers[frame < threshold[0]] = 1
         markers[frame > threshold[len(threshold) - 2]] = 2
     else:
@@ -39,6 +440,43 @@ def apply_watershed(frame, threshold, **kwargs):
     return mask
 
 
+# the labels of the regions that are measured, label 0 is the background
+def keep_regions(areas, min_size=20000, get_largest=False):
+    regions = np.arange(1, len(areas))
+    if len(regions) == 0:
+        return regions
+    elif not get_largest:
+        return regions[areas[1:] > min_size]
+    else:
+        return regions[areas[1:] == areas[1:].max()]
+
+
+DEFAULT_PROPERTIES = ["label", "area", "bbox_area", "convex_area", "eccentricity", "extent", "local_centroid",
+                      "major_axis_length", "minor_axis_length", "perimeter", "solidity", "weighted_local_centroid",
+                      "orientation"]
+
+
+# the properties of the regions in labels, the other regions have to be removed before, sums are the intensity sums
+# of all the labels
+def measure_regions(labels, image, sums, keep, properties=None, to_cache=True):
+    if np.issubdtype(image.dtype, np.integer):
+        sums = np.rint(sums).astype(np.int64)
+
+    if properties is None:
+        properties = DEFAULT_PROPERTIES
+    else:
+        # do not modify the callers list, this function is called once per frame
+        properties = ["label"] + [prop for prop in properties if prop != "label"]
+
+    attrs=regionprops_table(label_image=labels, intensity_image=image, properties=properties,
+                      cache=to_cache)
+
+    attrs = pd.DataFrame(attrs)
+    attrs.insert(1, "intensities", sums[keep])
+
+    return pd.DataFrame(attrs)
+
+
 #TODO I'm not calculating anything here
 def calculate_properties(mask, image, properties=None, to_cache=True, fill_holes=False, min_size=20000,
                          get_largest=False):
@@ -48,31 +486,52 @@ def calculate_properties(mask, image, properties=None, to_cache=True, fill_holes
     else:
         labels=label(mask)
 
-    intensities=[]
-    for lab in np.unique(labels):
-        if lab == 0:
-            continue
-        pix_sum = np.sum(image[labels == lab])
-        intensities.append(pix_sum)
+    # areas and intensity sums of all the regions in one pass, label 0 is the background
+    flat = labels.ravel()
+    areas = np.bincount(flat)
+    sums = np.bincount(flat, weights=image.ravel(), minlength=len(areas))
+    keep = keep_regions(areas, min_size=min_size, get_largest=get_largest)
 
-    if properties is None:
-        properties=["label", "area", "bbox_area", "convex_area", "eccentricity", "extent", "local_centroid",
-               "major_axis_length", "minor_axis_length", "perimeter", "solidity",
-               "weighted_local_centroid", "orientation"]
-    else:
-        properties.insert(0, "label")
+    # the small regions are removed before measuring them, the remaining ones keep their labels
+    if len(keep) < len(areas) - 1:
+        lookup = np.zeros(len(areas), dtype=labels.dtype)
+        lookup[keep] = keep
+        labels = lookup[labels]
 
-    attrs=regionprops_table(label_image=labels, intensity_image=image, properties=properties,
-                      cache=to_cache)
+    return measure_regions(labels, image, sums, keep, properties=properties, to_cache=to_cache)
 
-    attrs = pd.DataFrame(attrs)
-    attrs.insert(1, "intensities", intensities)
 
-    if not get_largest:
-        attrs=attrs[attrs["area"] > min_size]
-    else:
-        attrs=attrs[attrs["area"]==attrs["area"].max()]
+# the bounding box [y0, y1, x0, x1] of the bright parts of the frames plus margin pixels, the frames are combined
+# with their maximum so an object that moves in the frames is inside the box in all of them
+def bounding_roi(frames, margin=16, min_size=64):
+    projection = np.max(np.asarray(frames), axis=0)
+    if projection.min() == projection.max():
+        return [0, projection.shape[0], 0, projection.shape[1]]
+    foreground = projection > filt.threshold_otsu(projection)
+    # noise can be brighter than the threshold in a few pixels
+    labels = label(foreground)
+    areas = np.bincount(labels.ravel())
+    areas[0] = 0
+    foreground = areas[labels] >= min(min_size, areas.max())
+    rows = np.flatnonzero(foreground.any(axis=1))
+    cols = np.flatnonzero(foreground.any(axis=0))
+    return [int(max(rows[0] - margin, 0)), int(min(rows[-1] + 1 + margin, projection.shape[0])),
+            int(max(cols[0] - margin, 0)), int(min(cols[-1] + 1 + margin, projection.shape[1]))]
 
-    return pd.DataFrame(attrs)
+
+# the columns of regionprops that are in frame coordinates, the local ones are relative to the region
+ROW_COLUMNS = ["centroid-0", "weighted_centroid-0", "centroid_weighted-0", "bbox-0", "bbox-2"]
+COLUMN_COLUMNS = ["centroid-1", "weighted_centroid-1", "centroid_weighted-1", "bbox-1", "bbox-3"]
 
 
+# moves the coordinates of properties that were measured on a crop to the coordinates of the whole frame
+def shift_coordinates(measures, crop):
+    if crop is None:
+        return measures
+    measures = measures.copy()
+    for column in measures.columns:
+        if column in ROW_COLUMNS:
+            measures[column] = measures[column] + crop[0]
+        elif column in COLUMN_COLUMNS:
+            measures[column] = measures[column] + crop[2]
+    return measures
@@ -5,13 +5,281 @@ import matplotlib.animation as anim
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
 import numpy as np
-from skimage.filters import rank
-from skimage.morphology import disk
-from skimage.exposure import match_histograms
 import utils
-import h5py
+from raw import RawWriter
+from multiprocessing import Pool
 matplotlib.use("Agg")
 
+# frames (or masks) are kept in a single preallocated (frames, height, width) array that grows if needed,
+# indexing, iteration and len work like the lists that were used before
+class FrameStore:
+    def __init__(self, capacity=0, shape=None, dtype=None):
+        self.data = None
+        self.length = 0
+        self.capacity = capacity
+        if shape is not None and dtype is not None:
+            self.data = np.empty((max(capacity, 1),) + tuple(shape), dtype=dtype)
+
+    @classmethod
+    def from_frames(cls, frames):
+        if isinstance(frames, FrameStore):
+            return frames
+        elif isinstance(frames, np.ndarray) and frames.ndim == 3:
+            store = cls()
+            store.data = frames
+            store.length = frames.shape[0]
+            return store
+        store = cls(capacity=len(frames))
+        store.extend(frames)
+        return store
+
+    def grow(self, frame):
+        if self.data is None:
+            self.data = np.empty((max(self.capacity, 1),) + frame.shape, dtype=frame.dtype)
+        elif self.length == self.data.shape[0]:
+            # frame counts from the container are not always correct so grow the array by half
+            grown = np.empty((self.length + max(self.length // 2, 1),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.length] = self.data[:self.length]
+            self.data = grown
+
+    # returns a view of the next empty slot so a frame can be written into it without an extra copy
+    def next_slot(self, frame):
+        self.grow(frame)
+        self.length += 1
+        return self.data[self.length - 1]
+
+    def append(self, frame):
+        self.next_slot(frame)[...] = frame
+
+    def extend(self, frames):
+        if isinstance(frames, np.ndarray) and frames.ndim == 3 and len(frames) > 0:
+            # copy a whole block of frames at once
+            self.grow(frames[0])
+            if self.length + len(frames) > self.data.shape[0]:
+                grown = np.empty((self.length + len(frames),) + self.data.shape[1:], dtype=self.data.dtype)
+                grown[:self.length] = self.data[:self.length]
+                self.data = grown
+            self.data[self.length:self.length + len(frames)] = frames
+            self.length += len(frames)
+        else:
+            for frame in frames:
+                self.append(frame)
+
+    @property
+    def array(self):
+        if self.data is None:
+            return np.empty((0, 0, 0))
+        return self.data[:self.length]
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+
+# masks with two values (e.g. the background and the object of the watershed) with one bit per pixel, this is 8 times
+# smaller than uint8. Indexing and iteration return the unpacked masks so they can be used instead of a FrameStore
+class PackedMasks:
+    def __init__(self, values=(1, 2)):
+        self.values = np.array(values, dtype=np.uint8)
+        self.packed = []
+        self.frame_shape = None
+
+    @classmethod
+    def from_frames(cls, masks, values=(1, 2), chunk=64):
+        store = cls(values=values)
+        for start in range(0, len(masks), chunk):
+            store.extend(masks[start:start + chunk])
+        return store
+
+    def append(self, mask):
+        mask = np.asarray(mask)
+        if self.frame_shape is None:
+            self.frame_shape = mask.shape
+        elif mask.shape != self.frame_shape:
+            raise ValueError("all masks need to have the same shape")
+        high = mask == self.values[1]
+        if np.count_nonzero(high) + np.count_nonzero(mask == self.values[0]) != mask.size:
+            raise ValueError("packed masks can only have the values " + str(self.values.tolist()))
+        self.packed.append(np.packbits(high, axis=None))
+
+    def extend(self, masks):
+        for mask in masks:
+            self.append(mask)
+
+    def unpack(self, packed):
+        bits = np.unpackbits(packed, count=self.frame_shape[0] * self.frame_shape[1])
+        return self.values[bits].reshape(self.frame_shape)
+
+    @property
+    def array(self):
+        if len(self.packed) == 0:
+            return np.empty((0, 0, 0), dtype=np.uint8)
+        return np.stack([self.unpack(packed) for packed in self.packed])
+
+    @property
+    def shape(self):
+        if self.frame_shape is None:
+            return (0, 0, 0)
+        return (len(self.packed),) + self.frame_shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return sum(packed.nbytes for packed in self.packed)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            packed = self.packed[index]
+            if len(packed) == 0:
+                return np.empty((0,) + (self.frame_shape or (0, 0)), dtype=np.uint8)
+            return np.stack([self.unpack(mask) for mask in packed])
+        return self.unpack(self.packed[index])
+
+    def __iter__(self):
+        for packed in self.packed:
+            yield self.unpack(packed)
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+
+# skipped frames are only grabbed and not decoded
+def iterate_frames(capture, start=0, stop=None, step=1):
+    if start > 0:
+        capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    index = start
+    while stop is None or index < stop:
+        if (index - start) % step == 0:
+            ret, frame = capture.read()
+            if not ret or frame is None:
+                break
+            yield frame
+        elif not capture.grab():
+            break
+        index += 1
+
+
+def read_range(capture, frames, start=0, stop=None, step=1, invert=False, denoise=False, dsk=2, crop=None):
+    for frame in iterate_frames(capture, start=start, stop=stop, step=step):
+        if crop is not None:
+            frame = frame[crop[0]:crop[1], crop[2]:crop[3]]
+        utils.preprocess_frame(frame, invert=invert, denoise=denoise, dsk=dsk, out=frames.next_slot(frame[..., 0]))
+    return frames
+
+
+# runs in a worker process, every worker opens its own capture and seeks to the start of its range
+def decode_range(start, stop, step, path=None, invert=False, denoise=False, dsk=2, crop=None):
+    capture = cv.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError("Error opening the video file")
+    frames = read_range(capture, FrameStore(capacity=len(range(start, stop, step))), start=start, stop=stop,
+                        step=step, invert=invert, denoise=denoise, dsk=dsk, crop=crop)
+    capture.release()
+    return frames.array
+
+
+# the colors of a matplotlib colormap for the 256 values of an 8 bit image, in the BGR order of opencv
+def colormap_lut(colormap="viridis"):
+    colors = plt.get_cmap(colormap)(np.arange(256))[:, :3]
+    return np.round(colors[:, ::-1] * 255).astype(np.uint8)
+
+
+# scales the image to 0-255, without a range each image is scaled to its own minimum and maximum like imshow does
+def to_uint8(image, value_range=None):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        # the magnitude of optical flow with get="both"
+        image = image[..., 0]
+    if value_range is None:
+        if image.dtype == np.uint8:
+            return image
+        value_range = image.min(), image.max()
+    low, high = value_range
+    if high <= low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    scaled = (image.astype(np.float32) - low) * (255 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+# pixels that have a different label than the pixel below or to the right
+def label_borders(mask):
+    mask = np.asarray(mask)
+    borders = np.zeros(mask.shape, dtype=bool)
+    borders[:-1] |= mask[:-1] != mask[1:]
+    borders[:, :-1] |= mask[:, :-1] != mask[:, 1:]
+    return borders
+
+
+def compose_frame(frame, mask, lut, mask_range=None, contours=False, color=(0, 0, 255)):
+    left = cv.cvtColor(to_uint8(frame), cv.COLOR_GRAY2BGR)
+    mask = np.asarray(mask)
+    if mask.shape[:2] != left.shape[:2]:
+        # downsampled masks and flow calculated on a pyramid level
+        mask = cv.resize(mask, (left.shape[1], left.shape[0]), interpolation=cv.INTER_NEAREST)
+    if contours:
+        left[label_borders(mask if mask.ndim == 2 else mask[..., 0])] = color
+    if mask_range is None:
+        # the masks are always scaled, labels are small numbers even in 8 bit masks
+        mask_range = np.min(mask), np.max(mask)
+    right = lut[to_uint8(mask, mask_range)]
+    return np.concatenate([left, right], axis=1)
+
+
+# every period-th frame and mask are composed and streamed to the file so only one of them is in memory, with
+# normalize all the masks use the minimum and maximum of the written masks
+def write_video(output, frames, masks, FPS=10, period=30, normalize=False, contours=False, colormap="viridis"):
+    lut = colormap_lut(colormap)
+    mask_range = None
+    if normalize:
+        low, high = np.inf, -np.inf
+        for i in range(0, len(masks), period):
+            low = min(low, np.min(masks[i]))
+            high = max(high, np.max(masks[i]))
+        mask_range = low, high
+    writer = None
+    try:
+        for i in range(0, len(frames), period):
+            image = compose_frame(frames[i], masks[i], lut, mask_range=mask_range, contours=contours)
+            if writer is None:
+                writer = cv.VideoWriter(output, cv.VideoWriter_fourcc(*"mp4v"), FPS,
+                                        (image.shape[1], image.shape[0]))
+                if not writer.isOpened():
+                    raise IOError("Error opening the output video file")
+            writer.write(image)
+    finally:
+        if writer is not None:
+            writer.release()
+
+
 class Video:
     def __init__(self, path):
         if not os.path.isfile(path):
@@ -22,80 +290,192 @@ class Video:
             self.frames = []
             self.threshold = None
             self.masks = []
+            # the box [y0, y1, x0, x1] the frames were cropped to when they were read, None is the whole frame
+            self.crop = None
 
-    def get_frames(self, invert=False, denoise=False, dsk=None, inplace=True):
+    # assigning lists still works, they are copied into a FrameStore
+    @property
+    def frames(self):
+        return self._frames
+
+    @frames.setter
+    def frames(self, frames):
+        self._frames = FrameStore.from_frames(frames)
+
+    @property
+    def masks(self):
+        return self._masks
+
+    @masks.setter
+    def masks(self, masks):
+        self._masks = masks if isinstance(masks, PackedMasks) else FrameStore.from_frames(masks)
+
+    # start, stop and step select a range of frames and every step-th frame in it, with cores > 1 the range is
+    # split into parts that are seeked to and decoded in parallel, then put back together in order. With crop only
+    # the box [y0, y1, x0, x1] of every frame is kept, see detect_roi
+    def get_frames(self, invert=False, denoise=False, dsk=None, inplace=True, start=0, stop=None, step=1, cores=1,
+                   crop=None):
         if not self.video.isOpened():
             raise IOError("Error opening the video file")
         else:
-            frames=[]
-            while self.video.isOpened():
-                ret, frame = self.video.read()
-                if frame is None:
-                    print("Done reading video " + self.file)
-                    self.video.release()
-                    break
-                else:
-                    frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-                    if invert:
-                        frame = cv.bitwise_not(frame)
-                    if denoise:
-                        if dsk is None:
-                            print("Using default disk value 2")
-                            dsk = 2
-                        frame = rank.median(frame, disk(dsk))
-                frames.append(frame)
-                                
+            if step < 1:
+                raise ValueError("step needs to be a positive integer")
+            if denoise and dsk is None:
+                print("Using default disk value 2")
+                dsk = 2
+            count = int(self.video.get(cv.CAP_PROP_FRAME_COUNT))
+            if count > 0 and (stop is None or stop > count):
+                stop = count
+
+            if cores > 1 and stop is not None:
+                self.video.release()
+                decode = utils.curry(decode_range, path=self.file, invert=invert, denoise=denoise, dsk=dsk, crop=crop)
+                with Pool(cores) as p:
+                    parts = p.starmap(decode, utils.split_range(start, stop, step, cores))
+                frames = FrameStore(capacity=sum([len(part) for part in parts]))
+                for part in parts:
+                    frames.extend(part)
+            else:
+                expected = len(range(start, stop, step)) if stop is not None else 0
+                frames = FrameStore(capacity=max(expected, 1))
+                read_range(self.video, frames, start=start, stop=stop, step=step, invert=invert, denoise=denoise,
+                           dsk=dsk, crop=crop)
+                self.video.release()
+            print("Done reading video " + self.file)
+
             print("Done reading frames for " + self.file)
             if inplace:
                 self.frames=frames
+                self.crop = crop
             else:
                 return frames
 
-    def normalize_frames(self, frames=None, inplace=True, reference_frame=None):
+    # yields lists of at most chunk_size frames, every call opens its own capture so the
+    # video can be streamed more than once without keeping the frames in memory
+    def stream_frames(self, invert=False, denoise=False, dsk=None, chunk_size=100, start=0, stop=None, step=1,
+                      crop=None):
+        if chunk_size < 1:
+            raise ValueError("chunk_size needs to be a positive integer")
+        if denoise and dsk is None:
+            print("Using default disk value 2")
+            dsk = 2
+
+        capture = cv.VideoCapture(self.file)
+        if not capture.isOpened():
+            raise IOError("Error opening the video file")
+
+        chunk = []
+        try:
+            for frame in iterate_frames(capture, start=start, stop=stop, step=step):
+                chunk.append(utils.preprocess_frame(frame, invert=invert, denoise=denoise, dsk=dsk, crop=crop))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if len(chunk) > 0:
+                yield chunk
+        finally:
+            capture.release()
+        print("Done streaming frames for " + self.file)
+
+    def read_frame(self, index, invert=False, denoise=False, dsk=None, crop=None):
+        if denoise and dsk is None:
+            dsk = 2
+        capture = cv.VideoCapture(self.file)
+        if not capture.isOpened():
+            raise IOError("Error opening the video file")
+        capture.set(cv.CAP_PROP_POS_FRAMES, index)
+        ret, frame = capture.read()
+        capture.release()
+        if frame is None:
+            raise IndexError("could not read frame " + str(index) + " from " + self.file)
+        return utils.preprocess_frame(frame, invert=invert, denoise=denoise, dsk=dsk, crop=crop)
+
+    # the box [y0, y1, x0, x1] around the object in the first count frames (every step-th frame from start) plus
+    # margin pixels on every side, the object should be brighter than the background (use invert otherwise). With
+    # spread the count frames are spread over the frames from start to stop instead, this is slower but also finds
+    # an object that moves during the video
+    def detect_roi(self, count=10, margin=16, start=0, stop=None, step=1, invert=False, spread=False):
+        frames = []
+        if spread:
+            capture = cv.VideoCapture(self.file)
+            length = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+            capture.release()
+            stop = length if stop is None else min(stop, length)
+            indices = np.unique(np.linspace(start, max(stop - 1, start), count).astype(int))
+            frames = [self.read_frame(index, invert=invert) for index in indices]
+        else:
+            for chunk in self.stream_frames(invert=invert, chunk_size=count, start=start, stop=start + count * step,
+                                            step=step):
+                frames.extend(chunk)
+        if len(frames) == 0:
+            raise ValueError("could not read any frames from " + self.file)
+        return utils.bounding_roi(frames, margin=margin)
+
+    # denoising as a separate step after reading the frames, see utils.denoise_frames for the methods
+    def denoise(self, method="rank", dsk=2, window=3, frames=None, inplace=True, cores=1, pool="process"):
+        if frames is None and len(self.frames)==0:
+            raise ValueError("You did not specify any frames")
+
+        if frames is not None:
+            frames=frames
+        else:
+            frames=self.frames
+
+        denoised = FrameStore.from_frames(utils.denoise_frames(frames, method=method, dsk=dsk, window=window,
+                                                               cores=cores, pool=pool))
+        if inplace:
+            self.frames = denoised
+        else:
+            return denoised
+
+    # reference can be an ndarray instead of an index, this is used when the frames are streamed
+    # in chunks and the reference frame is not in the current chunk
+    def normalize_frames(self, frames=None, inplace=True, reference_frame=None, reference=None, dtype=None,
+                         cores=1):
         if frames is None and len(self.frames)==0:
             raise ValueError("You did not specify any frames")
-                
+
         if frames is not None:
             frames=frames
         else:
             frames=self.frames
-                
-        if reference_frame is None:
+
+        if reference is not None and reference_frame is not None:
+            raise ValueError("Provided both a reference frame index and a reference frame")
+        elif reference is None and reference_frame is None:
             print("No reference frame provided using the first frame as reference")
             reference_frame = 0
-            
-        adjusted_frames = []
-        for i in range(len(frames)):
-            if i == reference_frame:
-                continue
-            else:
-                matched = match_histograms(frames[i], frames[reference_frame], multichannel=False)
-                adjusted_frames.append(matched)
+
+        if reference is None:
+            reference = frames[reference_frame]
+
+        # the reference frame is matched to itself so the frames stay aligned with the masks
+        adjusted_frames = FrameStore.from_frames(utils.normalize_frames(frames, reference, dtype=dtype, cores=cores))
         if inplace:
             self.frames = adjusted_frames
         else:
             return adjusted_frames
 
-    def adjust(self, method, frames=None, inplace=True, **kwargs):
-        
+    def adjust(self, method, frames=None, inplace=True, dtype=None, cores=1, **kwargs):
+
         if frames is None and len(self.frames)==0:
             raise ValueError("You did not specify any frames")
-                
+
         if frames is not None:
             frames=frames
         else:
             frames=self.frames
-            
-        adjusted = []               
 
-        for frame in frames:
-            adjusted.append(utils.adjust(frame, method, **kwargs))
+        adjusted = FrameStore.from_frames(utils.adjust_frames(frames, method, dtype=dtype, cores=cores, **kwargs))
         if inplace:
             self.frames = adjusted
         else:
             return adjusted
 
-    def write_mp4(self, output, frames=None, masks=None, size=(6, 3), FPS=10, period=30, normalize=False):
+    # with the opencv backend the frame and the colormapped mask are put side by side and written one at a time, with
+    # contours the borders of the labels in the mask are drawn on the frame. size is only used by matplotlib
+    def write_mp4(self, output, frames=None, masks=None, size=(6, 3), FPS=10, period=30, normalize=False,
+                  backend="opencv", contours=False, colormap="viridis"):
         if len(self.frames) == 0 and frames is None:
             raise ValueError("you did not specify any frames")
         elif frames is None and len(self.frames) > 0:
@@ -112,14 +492,17 @@ class Video:
 
         if len(frames) != len(masks):
             raise ValueError("the number frames do not match number of masks")
+        elif backend == "opencv":
+            write_video(output, frames, masks, FPS=FPS, period=period, normalize=normalize, contours=contours,
+                        colormap=colormap)
+        elif backend != "matplotlib":
+            raise ValueError("backend can be 'opencv' or 'matplotlib'")
         else:
             fig, (ax1, ax2) = plt.subplots(1,2)
             fig.set_size_inches(size)
             ims=[]
             if normalize:
-                stacked = np.stack(masks, axis=2)
-                max_val = stacked.max()
-                min_val = stacked.min()
+                min_val, max_val = utils.min_max(masks)
             for i in range(len(frames)):
                 if i % period == 0:
                     im1 = ax1.imshow(frames[i], animated=True)
@@ -133,7 +516,18 @@ class Video:
             ani = anim.ArtistAnimation(fig, ims, interval=int(np.round(1000 / FPS)))
             ani.save(output)
 
-    def write_raw(self, output, frames=None, masks=None, thresholds=None):
+    # the heatmap is the mean (or moving average) of the masks from the movement reducer
+    def write_heatmap(self, output, heatmap, size=(6, 3)):
+        fig, ax = plt.subplots(1, 1)
+        fig.set_size_inches(size)
+        im = ax.imshow(heatmap)
+        fig.colorbar(im, ax=ax)
+        fig.savefig(output)
+        plt.close(fig)
+
+    # the frames and masks are written in blocks of chunk frames, see raw.py for the layout of the file
+    def write_raw(self, output, frames=None, masks=None, thresholds=None, compression="gzip", params=None, chunk=64,
+                  crop=None):
         if len(self.frames) == 0 and frames is None:
             raise ValueError("you did not specify any frames")
         elif frames is None and len(self.frames) > 0:
@@ -149,12 +543,13 @@ class Video:
         if len(frames) != len(masks):
             raise ValueError("the number frames do not match number of masks")
 
-        f=h5py.File(output, "w-")
-        fs = f.create_group("frames")
-        ms = f.create_group("masks")
-        fs.create_dataset("frames", data=np.stack(frames, axis=2))
-        ms.create_dataset("masks", data=np.stack(masks, axis=2))
-        f.close()
+        if crop is None:
+            crop = self.crop
+        with RawWriter(output, compression=compression, params=params, crop=crop) as writer:
+            for start in range(0, len(frames), chunk):
+                stop = min(start + chunk, len(frames))
+                writer.append(frames[start:stop], masks[start:stop],
+                              None if thresholds is None else thresholds[start:stop])
 
         print("Done writing raw data")
         return None